@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+if __name__ == '__main__':
+	import argparse
+	import json
+	from doom.bench import run, compare, benchmarks
+
+	parser = argparse.ArgumentParser(
+		description='Time the hot paths of the doom package against generated fixtures (no IWADs needed). '
+			'Results can be saved as JSON and compared against a previous run.'
+	)
+	parser.add_argument(
+		'-mode',
+		choices=['cold', 'warm'],
+		default='warm',
+		help='Cold starts every run with empty caches, warm primes them first.'
+	)
+	parser.add_argument(
+		'-repeat',
+		help='How many times to run each benchmark.',
+		default=5,
+		type=int
+	)
+	parser.add_argument(
+		'-size',
+		help='Multiplies the number of lumps in the fixtures.',
+		default=1,
+		type=int
+	)
+	parser.add_argument(
+		'-only',
+		action='append',
+		choices=[name for name, setup in benchmarks],
+		help='Only run this benchmark. Can be used multiple times.'
+	)
+	parser.add_argument(
+		'-json',
+		help='Write results to this file.'
+	)
+	parser.add_argument(
+		'-baseline',
+		help='Compare against results previously written with -json. Exits with an error on any regression.'
+	)
+	parser.add_argument(
+		'-threshold',
+		help='How much slower (as a fraction) counts as a regression.',
+		default=0.1,
+		type=float
+	)
+	args = parser.parse_args()
+
+	results = run(mode=args.mode, repeat=args.repeat, size=args.size, only=args.only)
+	if args.json:
+		with open(args.json, 'w') as fh:
+			json.dump(results, fh, indent='\t')
+		print('Results written to: ' + args.json)
+	if args.baseline:
+		with open(args.baseline) as fh:
+			baseline = json.load(fh)
+		if compare(results, baseline, args.threshold):
+			exit(1)
@@ -3,7 +3,8 @@
 if __name__ == '__main__':
 	import argparse
 	from os.path import split, join
-	from doom.util import chain_args, get_chains, mkzip, bleeps
+	from os import cpu_count
+	from doom.util import chain_args, profile_args, start_profile, end_profile, daemon_args, forward_daemon, get_chains, mkzip, bleeps
 
 	parser = argparse.ArgumentParser(
 		description='Generate a bleeps package (Replace sounds with PC Speaker ones). '
@@ -19,12 +20,27 @@ if __name__ == '__main__':
 		action='store_true',
 		help='Dont create the PK3 normally provided for convenience'
 	)
+	parser.add_argument(
+		'-cpu',
+		help='How many cpu workers to use for rendering and encoding, otherwise dont use multiprocessing. "0" will match the CPU cores on the system.',
+		default=1,
+		type=int
+	)
+	profile_args(parser)
+	daemon_args(parser)
 	
 	args = parser.parse_args()
-	chains = get_chains(args)
+	forward_daemon(args, __file__)
+	start_profile(args)
+	chains = get_chains(args, prefetch=True)
 
-	dir_path = bleeps(chains, path=args.path)
+	if args.cpu == 0:
+		args.cpu = cpu_count()
+
+	dir_path = bleeps(chains, path=args.path, cpu=args.cpu)
 	if not args.nopk3:
 		pk3_path = join('out', split(dir_path)[-1] + '.pk3')
 		mkzip(pk3_path, dir_path)
 		print('Generated: ' + pk3_path)
+
+	end_profile(args)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+if __name__ == '__main__':
+	import argparse
+	from doom.daemon import serve
+
+	parser = argparse.ArgumentParser(
+		description='Keep a server running for extract.py, hires.py and bleeps.py to hand their work to with -daemon. '
+			'Imports, WAD indexes, waifu2x models and recently cached data stay loaded between jobs, so repeated runs skip the warm up. '
+			'Jobs run one at a time.'
+	)
+	parser.add_argument(
+		'-socket',
+		help='Unix socket to listen on.',
+		default='wadsnip.sock'
+	)
+	parser.add_argument(
+		'-memory',
+		help='MB of cached data to keep in memory between jobs.',
+		default=512,
+		type=int
+	)
+	args = parser.parse_args()
+
+	serve(args.socket, memory=args.memory)
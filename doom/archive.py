@@ -5,6 +5,7 @@ import os
 import io
 from fnmatch import fnmatch
 from os import remove
+from threading import Lock
 
 # Execute statement and return default on failure
 def default(statement, default_value):
@@ -52,6 +53,47 @@ class Archives():
 			for header in archive.headers(name_match, namespace_match):
 				yield header
 	
+	# Async version of headers(), each header gets an 'aread' coroutine function to go with 'get_data'
+	# Data is read in batches on a bounded thread pool ahead of the consumer, so decoding can overlap with I/O.
+	# Wads merge adjacent lumps of a batch into single large reads, see Wad.get_data_many
+	async def aheaders(self, name_match='*', namespace_match='*', workers=4, batch=64):
+		import asyncio
+		from collections import deque
+		from concurrent.futures import ThreadPoolExecutor
+		
+		def aread_f(future, i):
+			async def aread():
+				return (await future)[i]
+			return aread
+		
+		loop = asyncio.get_running_loop()
+		pending = deque()
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			def submit(archive, chunk):
+				future = loop.run_in_executor(executor, archive.get_data_many, [header['handle'] for header in chunk])
+				pending.append((chunk, future))
+			
+			for archive in self.archives:
+				chunk = []
+				for header in archive.headers(name_match, namespace_match):
+					chunk.append(header)
+					if len(chunk) >= batch:
+						submit(archive, chunk)
+						chunk = []
+					# Only keep so many batches in flight, hand out the oldest one first
+					while len(pending) > workers:
+						headers, future = pending.popleft()
+						for i, header in enumerate(headers):
+							header['aread'] = aread_f(future, i)
+							yield header
+				if chunk:
+					submit(archive, chunk)
+			while pending:
+				headers, future = pending.popleft()
+				for i, header in enumerate(headers):
+					header['aread'] = aread_f(future, i)
+					yield header
+	
 	def namespaces(self):
 		from doom.util import merge_dict
 		namespaces = {}
@@ -92,6 +134,13 @@ class Archive():
 			header['get_data'] = get_data_f(header['handle'])
 			yield header
 
+	def aheaders(self, name_match='*', namespace_match='*', workers=4, batch=64):
+		return Archives(self).aheaders(name_match, namespace_match, workers, batch)
+
+	# Read several lumps at once, archives that can do better than one at a time should override this
+	def get_data_many(self, handles):
+		return [self.get_data(handle) for handle in handles]
+
 	def namespaces(self):
 		# Get last header (not overridden) for each namespace
 		# TODO: Add special cases for types like TEXTURES.wood that don't get overridden with different extensions
@@ -119,6 +168,28 @@ class Archive():
 	def __add__(self, other):
 		return Archives(self, other)
 
+	# Do the (deferred) indexing now, say from a thread while other archives open
+	def prefetch(self):
+		pass
+
+	# Set of every lump name (lowercase), for quick lookups like IWAD identification
+	def lump_names(self):
+		return frozenset(header['name'] for header in self.get_lump_headers())
+
+	# PNAMES names for the next archive in a chain to recognize patches by, given the ones this archive got (see Wad.patch_names)
+	def chain_patch_names(self, patch_names):
+		return patch_names
+
+	# Copy a lump into a ZipWriter as arcname without decompressing and recompressing it
+	# Returns False if this archive can't, then it's up to the caller to write the data itself
+	def copy_member(self, handle, writer, arcname):
+		return False
+
+	# Identifies the contents without reading them, for memoizing anything worked out from an archive. None if there's no cheap way
+	@property
+	def digest(self):
+		return None
+
 	def __iter__(self):
 		headers = self.get_lump_headers()
 		for header in headers:
@@ -142,17 +213,44 @@ class Pk3(Archive):
 	def __init__(self, path):
 		self.path = path
 		self.file = zipfile.ZipFile(path)
+		# For copy_member, which might run after a chdir (see doom.util.mkzip)
+		self.real_path = os.path.abspath(path)
+		self.raw_file = None
 		# For lump filtering
 		self.game = None
 		self.gametype = None
-		self.namelist = self.scan_subarchives(self.file.namelist())
+		# Nested archives are copied out on first use, see namelist
+		self._namelist = None
+		self.subarchives = {}
+		self._digest = None
+		# Passed on to nested WADs, see Wad.patch_names
+		self.patch_names = None
 
 	# TODO: __del__ is shitty and I should find a better way to guarantee the cleanup of tmp files
 	def __del__(self):
+		if self.raw_file:
+			self.raw_file.close()
 		if self.subarchives:
 			for subarchive in self.subarchives.values():
 				remove(subarchive.path)
 
+	@property
+	def namelist(self):
+		if self._namelist is None:
+			self._namelist = self.scan_subarchives(self.file.namelist())
+		return self._namelist
+
+	def prefetch(self):
+		self.namelist
+
+	# Names, CRCs and sizes of every member
+	@property
+	def digest(self):
+		from hashlib import md5
+		if self._digest is None:
+			self._digest = md5(repr([(info.filename, info.CRC, info.file_size) for info in self.file.infolist()]).encode()).digest()
+		return self._digest
+
 	def scan_subarchives(self, namelist):
 		from os.path import splitext
 		from tempfile import mkstemp
@@ -180,6 +278,7 @@ class Pk3(Archive):
 				save_data(self.get_data(name), tmpfile)
 				if ext in ['.wad', '.iwad']:
 					self.subarchives[name] = Wad(tmpfile)
+					self.subarchives[name].patch_names = self.patch_names
 				else:
 					self.subarchives[name] = Pk3(tmpfile)
 				continue
@@ -231,6 +330,7 @@ class Pk3(Archive):
 				'namespace': namespace,
 				'extension': extension,
 				'handle': handle,
+				'archive': self,
 				'type': None,
 				'filter': filt,
 				'data': self.get_data(handle) if with_data else None
@@ -241,6 +341,7 @@ class Pk3(Archive):
 			subheaders = archive.get_lump_headers(name_match, namespace_match, with_data)
 			for i in range(len(subheaders)):
 				subheaders[i]['handle'] = (name ,subheaders[i]['handle'])
+				subheaders[i]['archive'] = self
 			headers += subheaders
 		return headers
 	
@@ -253,8 +354,69 @@ class Pk3(Archive):
 		lump_file.close()
 		return data
 
+	# Raw copy of the compressed bytes, CRC and sizes straight from the local file entry into a ZipWriter
+	# Read through a handle of its own, the ZipFile's is in use by get_data
+	def copy_member(self, handle, writer, arcname):
+		if isinstance(handle, tuple):
+			name, subhandle = handle
+			return self.subarchives[name].copy_member(subhandle, writer, arcname)
+		info = self.file.getinfo(handle)
+		# Encrypted members aren't worth the trouble
+		if info.flag_bits & 0x1:
+			return False
+		if self.raw_file is None:
+			self.raw_file = open(self.real_path, 'rb')
+		self.raw_file.seek(info.header_offset)
+		local = self.raw_file.read(30)
+		if local[:4] != b'PK\x03\x04':
+			return False
+		name_length, extra_length = struct.unpack('<HH', local[26:30])
+		self.raw_file.seek(info.header_offset + 30 + name_length + extra_length)
+		raw = self.raw_file.read(info.compress_size)
+		writer.write_raw(arcname, raw, info.CRC, info.file_size, info.compress_type, flag_bits=info.flag_bits, date_time=info.date_time, external_attr=info.external_attr)
+		return True
+
+# Signatures of common image formats, PIL would pick these up before any of the Doom formats are tried
+image_magics = [b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a']
+
+# Raw image sizes from doom.graphic.Raw, any multiple of 320 (AUTOPAGE) is fine too
+raw_sizes = set(width * height for width, height in [(64, 64), (64, 65), (64, 128), (128, 128), (256, 256), (320, 200), (320, 158), (16, 16), (48, 48), (32, 64)])
+
+# Quick type recognition from the start of a lump and its total size, same order and sanity checks as the full decode in id_type
+# data can just be the first few bytes of the lump, returns None if nothing matched (or not enough data to tell)
+def sniff_type(data, size=None):
+	if size is None:
+		size = len(data)
+	if len(data) >= 4:
+		# https://doomwiki.org/wiki/Sound
+		dmx_format = data[0] | (data[1] << 8)
+		if dmx_format == 0 and size == 4 + (data[2] | (data[3] << 8)):
+			return "sounds_pcspkr"
+		if dmx_format == 3 and len(data) >= 8 and size == 8 + int.from_bytes(data[4:8], 'little'):
+			return "sounds_digital"
+		if data[:4] == b'MUS\x1A':
+			return "music"
+	if any(data.startswith(magic) for magic in image_magics):
+		return "graphics"
+	# Picture header and column offsets, see doom.graphic.Picture
+	if size >= 13 and len(data) >= 8:
+		width, height = struct.unpack_from('<HH', data)
+		if height > 0 and height <= 2048 and width > 0 and width <= 2048 and width < size / 4:
+			if len(data) >= 8 + width * 4:
+				if all(offset < size for offset, in struct.iter_unpack('<I', data[8:8 + width * 4])):
+					return "graphics"
+			else:
+				return None
+	if size in raw_sizes or size % 320 == 0:
+		return "graphics"
+	return None
+
 # Try to find out if the data is sound or graphic or the like, return namespace name (ish)
+# Signatures are checked first, anything they can't place gets the (slow) trial decode
 def id_type(data):
+	ns = sniff_type(data)
+	if ns:
+		return ns
 	from doom.sound import Dmx
 	from doom.music import Mus
 	from doom.graphic import ZImage
@@ -278,18 +440,140 @@ def id_type(data):
 		pass
 	return None
 
+# Least recently used entries go first once over max_entries, like doom.util.MemoryCache but counting entries
+# Every Wad gets its own copy of a classification, so nothing it does to one can leak into the others
+class IndexCache():
+	def __init__(self, max_entries):
+		self.max_entries = max_entries
+		# Insertion ordered, oldest first
+		self.entries = {}
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key):
+		namespaced = self.entries.pop(key, None)
+		if namespaced is None:
+			return None
+		self.entries[key] = namespaced
+		return copy_namespaced(namespaced)
+
+	def put(self, key, namespaced):
+		self.entries.pop(key, None)
+		self.entries[key] = copy_namespaced(namespaced)
+		while len(self.entries) > self.max_entries:
+			del self.entries[next(iter(self.entries))]
+
+	def clear(self):
+		self.entries.clear()
+
+# Lumps are (pointer, size, name) tuples, maps are lists of them
+def copy_namespaced(namespaced):
+	return {namespace: [list(entry) if isinstance(entry, list) else entry for entry in entries] for namespace, entries in namespaced.items()}
+
+# How each WAD was classified, keyed by path, modification time, size and the PNAMES it was classified with (see Wad.patch_names)
+# The same WAD in several chains (or daemon jobs, see doom.daemon) only gets classified once, and the daemon only keeps so many. Set to None to turn it off
+wad_index_cache = IndexCache(64)
+
+def wad_index_key(path, patch_names=None):
+	stat = os.stat(path)
+	return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, patch_names)
+
+# For a process pool, see prefetch_wads
+def wad_index(path, patch_names=None):
+	wad = Wad(path)
+	wad.patch_names = patch_names
+	return wad.index_key, wad.namespaced
+
+# Classify several (opened) WADs at once in worker processes, it's mostly Python so threads would just take turns. Results go in wad_index_cache for the Wads to pick up
+# Workers get each WAD's patch_names along with it, they don't see anything else from the chain
+def prefetch_wads(wads):
+	from concurrent.futures import ProcessPoolExecutor
+	if wad_index_cache is None:
+		return
+	todo = {}
+	for wad in wads:
+		key = wad.index_key
+		if key not in wad_index_cache:
+			todo[key] = (wad.path, wad.patch_names)
+	workers = min(len(todo), os.cpu_count() or 1)
+	# Not worth starting processes for
+	if workers < 2:
+		return
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		for key, index in executor.map(wad_index, *zip(*todo.values())):
+			wad_index_cache.put(key, index)
+
 class Wad(Archive):
 	def __init__(self, path):
 		self.path = path
 		self.file = open(path, 'rb')
-		self.wad_dir, self.is_iwad = self.get_wad_dir()
+		# Reads seek on the shared file, so they need to be serialized when used from threads (aheaders)
+		self.lock = Lock()
 		self.game = None
 		self.gametype = None
-		self.get_wad_namespaces()
+		# Classifying every lump is the slow part of opening a WAD, so it waits until something asks for them
+		self._namespaced = None
+		self._digest = None
+		self._lump_names = None
+		self._pnames = False
+		# Names from the last PNAMES earlier in the chain, lumps by those names are patches when this WAD has no PNAMES of its own
+		# Set before anything is classified, see doom.util.get_chains
+		self.patch_names = None
+		self.wad_dir, self.is_iwad = self.get_wad_dir()
 	
 	def __del__(self):
 		self.file.close()
 
+	@property
+	def namespaced(self):
+		if self._namespaced is None:
+			# Might have been classified through another Wad since this one was opened
+			if wad_index_cache is not None:
+				self._namespaced = wad_index_cache.get(self.index_key)
+			if self._namespaced is None:
+				self.get_wad_namespaces()
+		return self._namespaced
+
+	# Classification only depends on the chain's PNAMES if this WAD has none
+	@property
+	def index_key(self):
+		return wad_index_key(self.path, None if self.pnames() else self.patch_names)
+
+	# Its own (last) PNAMES, if any
+	def pnames(self):
+		from doom.info import PNames
+		if self._pnames is False:
+			self._pnames = None
+			for pointer, size, name in self.wad_dir:
+				if name == 'PNAMES':
+					self._pnames = PNames(self.get_data((pointer, size, name)))
+		return self._pnames
+
+	def chain_patch_names(self, patch_names):
+		pnames = self.pnames()
+		return tuple(pnames.entries) if pnames else patch_names
+
+	def prefetch(self):
+		self.namespaced
+
+	# Straight from the directory, so nothing has to be classified. Includes markers and map lumps
+	def lump_names(self):
+		if self._lump_names is None:
+			self._lump_names = frozenset(name.lower() for pointer, size, name in self.wad_dir)
+		return self._lump_names
+
+	# The directory, which has every name, size and position
+	@property
+	def digest(self):
+		from hashlib import md5
+		if self._digest is None:
+			self._digest = md5(repr((self.is_iwad, self.wad_dir)).encode()).digest()
+		return self._digest
+
 	# Return the directory of a wad as a list of tuples (pointer, size, name)
 	# https://doomwiki.org/wiki/WAD
 	def get_wad_dir(self):
@@ -323,6 +607,7 @@ class Wad(Archive):
 							'extension': 'lmp',
 							'type': default("namespace.split('_')[1]", None),
 							'handle': (pointer, size, name),
+							'archive': self,
 							'filter': self.game,
 							'data': self.get_data((pointer, size, name)) if with_data else None
 						})
@@ -336,6 +621,7 @@ class Wad(Archive):
 							'extension': extension,
 							'type': default("namespace.split('_')[1]", None),
 							'handle': map_dir,
+							'archive': self,
 							'filter': self.game,
 							'data': self.get_data(map_dir) if with_data else None
 						})
@@ -345,33 +631,46 @@ class Wad(Archive):
 		# if map:
 		if isinstance(handle, list):
 			return self.extract_wad(handle)
-		else:
+		with self.lock:
 			(pointer, size, name) = handle
 			self.file.seek(pointer)
 			return self.file.read(size)
 
+	# Coalesce reads, lumps that are adjacent (or close enough) in the wad are grabbed with one large read and sliced apart
+	# Maps are extracted as usual
+	def get_data_many(self, handles, max_gap=4096):
+		data = [None] * len(handles)
+		lumps = []
+		for i, handle in enumerate(handles):
+			if isinstance(handle, list):
+				data[i] = self.get_data(handle)
+			else:
+				lumps.append((handle[0], handle[1], i))
+		lumps.sort()
+		
+		spans = []
+		for pointer, size, i in lumps:
+			if spans and pointer <= spans[-1][1] + max_gap:
+				spans[-1][1] = max(spans[-1][1], pointer + size)
+				spans[-1][2].append((pointer, size, i))
+			else:
+				spans.append([pointer, pointer + size, [(pointer, size, i)]])
+		
+		with self.lock:
+			for start, end, members in spans:
+				self.file.seek(start)
+				chunk = self.file.read(end - start)
+				for pointer, size, i in members:
+					data[i] = chunk[pointer - start:pointer - start + size]
+		return data
+
 	def extract_wad(self, wad_dir, iwad=False):
-		wad_type = b'IWAD' if iwad else b'PWAD'
 		out_file = io.BytesIO()
-		data_size = 0
-		for (pointer, size, name) in wad_dir:
-			data_size += size
-		
-		# header
-		out_file.write(struct.pack('4sii', wad_type, len(wad_dir), data_size + 12))
-		new_dir = []
-		# data
-		for (pointer, size, name) in wad_dir:
-			self.file.seek(pointer)
-			new_dir.append((out_file.tell(), size, name))
-			out_file.write(self.file.read(size))
-		# directory
-		for (pointer, size, name) in new_dir:
-			out_file.write(struct.pack('ii8s', pointer, size, name.encode()))
-		out_file.seek(0)
-		wad_bytes = out_file.read()
-		out_file.close()
-		return wad_bytes
+		# No dedup, lumps keep a copy each just like the source
+		with WadWriter(out_file, iwad=iwad, dedup=False) as writer:
+			for handle in wad_dir:
+				writer.add_lump(self, handle)
+		return out_file.getvalue()
 
 	# https://doomwiki.org/wiki/Lump
 	# A list of names that might occur after a 'THINGS' lump for a Doom/Hexen map definition or a port
@@ -487,9 +786,20 @@ class Wad(Archive):
 		]
 	}
 
+	# Identify a batch of directory entries in one go, only the start of each lump is read (coalesced) for sniff_type
+	# Entries that can't be identified from that fall back to id_type on the full lump
+	def id_types(self, entries, head_size=8 + 2048 * 4):
+		heads = self.get_data_many([(pointer, min(size, head_size), name) for pointer, size, name in entries])
+		types = []
+		for entry, head in zip(entries, heads):
+			ns = sniff_type(head, entry[1])
+			if not ns:
+				ns = id_type(self.get_data(entry))
+			types.append(ns)
+		return types
+
 	# Given a wad directory, attempt to separate lumps into types
 	def get_wad_namespaces(self):
-		from doom.info import PNames
 		from copy import deepcopy
 		
 		# Group into (mostly) GZDoom namespaces for folder dump.
@@ -536,12 +846,13 @@ class Wad(Archive):
 			'VX': 'voxels'
 		}
 		
-		# Grab PNAMES and process patches first if it exists
-		pnames = None
-		for pointer, size, name in self.wad_dir:
-			if name == 'PNAMES':
-				pnames = PNames(self.get_data((pointer, size, name)))
-				self.known_names['patches'] = pnames.entries
+		# Grab PNAMES and process patches first if it exists, otherwise recognize patches by the chain's PNAMES
+		known_names = dict(self.known_names)
+		pnames = self.pnames()
+		if pnames:
+			known_names['patches'] = pnames.entries
+		elif self.patch_names:
+			known_names['patches'] = list(self.patch_names)
 		# Pick up and duplicate anything used as a patch from PNAMES into the patch namespace
 		# This is necessary for textures like SLAD10 from Final Doom, which uses a sprite
 		if pnames:
@@ -549,6 +860,8 @@ class Wad(Archive):
 				if name in pnames:
 					wad_namespaces['patches'].append((pointer, size, name))
 
+		# Lumps that need type recognition, identified all at once after the directory is walked
+		unidentified = []
 		wad_dir = deepcopy(self.wad_dir)
 		while wad_dir:
 			# Consume regular Doom/Hexen maps
@@ -586,8 +899,8 @@ class Wad(Archive):
 				wad_dir.pop(0)
 			# Consume by known name lists
 			else:
-				for namespace, names in self.known_names.items():
-					if any(fnmatch(wad_dir[0][2], pattern) for pattern in self.known_names[namespace]):
+				for namespace, names in known_names.items():
+					if any(fnmatch(wad_dir[0][2], pattern) for pattern in names):
 						wad_namespaces[namespace].append(wad_dir.pop(0))
 						break
 				else:
@@ -596,15 +909,320 @@ class Wad(Archive):
 						wad_dir.pop(0)
 						continue
 					# patches are already handled at the top
-					if wad_dir[0][2] in pnames:
+					if pnames and wad_dir[0][2] in pnames:
 						wad_dir.pop(0)
 						continue
-					# Try type recognition
-					ns = id_type(self.get_data(wad_dir[0]))
-					if ns:
-						wad_namespaces[ns].append(wad_dir.pop(0))
-					else:
-						print('Unrecognized lump \"' + wad_dir[0][2] + '\". Treating as global data.')
-						wad_namespaces['global'].append(wad_dir.pop(0))
+					# Hold its place in global for now, type recognition happens below
+					unidentified.append(wad_dir[0])
+					wad_namespaces['global'].append(wad_dir.pop(0))
+		
+		# Only global is shared with other sources, the namespaces type recognition can produce are otherwise empty, so order is preserved
+		identified = set()
+		for entry, ns in zip(unidentified, self.id_types(unidentified)):
+			if ns:
+				wad_namespaces[ns].append(entry)
+				identified.add(entry)
+			else:
+				print('Unrecognized lump \"' + entry[2] + '\". Treating as global data.')
+		if identified:
+			wad_namespaces['global'] = [entry for entry in wad_namespaces['global'] if entry not in identified]
 		
-		self.namespaced = wad_namespaces
+		self._namespaced = wad_namespaces
+		if wad_index_cache is not None:
+			wad_index_cache.put(self.index_key, self._namespaced)
+
+def fileno(file):
+	try:
+		return file.fileno()
+	except (AttributeError, io.UnsupportedOperation):
+		return None
+
+# Copy size bytes between file descriptors at the given offsets without going through Python, returns False if the OS can't
+# copy_file_range can share blocks on filesystems that support it, sendfile at least stays in the kernel
+def copy_range(src_fd, src_offset, dst_fd, dst_offset, size):
+	if hasattr(os, 'copy_file_range'):
+		try:
+			while size > 0:
+				copied = os.copy_file_range(src_fd, dst_fd, size, src_offset, dst_offset)
+				if copied == 0:
+					break
+				src_offset += copied
+				dst_offset += copied
+				size -= copied
+			if size == 0:
+				return True
+		except OSError:
+			pass
+	if hasattr(os, 'sendfile'):
+		try:
+			os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+			while size > 0:
+				sent = os.sendfile(dst_fd, src_fd, src_offset, size)
+				if sent == 0:
+					break
+				src_offset += sent
+				size -= sent
+			if size == 0:
+				return True
+		except OSError:
+			pass
+	return False
+
+# Writes a WAD out as it goes, to a path or a binary file object
+# Lumps from other WADs (add_lump) are copied file to file by the OS where it can, identical lumps share one copy of the data with dedup (by content),
+# lump data starts on a multiple of align, and append adds to the end of an existing WAD (the old directory is written over and rewritten at the end)
+# https://doomwiki.org/wiki/WAD
+class WadWriter():
+	def __init__(self, out, iwad=False, dedup=True, align=1, append=False):
+		self.owned = isinstance(out, str)
+		if self.owned:
+			out = open(out, 'r+b' if append else 'wb')
+		self.file = out
+		self.fd = fileno(out)
+		self.dedup = dedup
+		self.align = align
+		# (pointer, size, name)
+		self.directory = []
+		# Dedup keys to (pointer, size)
+		self.written = {}
+		self.iwad = iwad
+		if append:
+			self.file.seek(0)
+			wad_type, num_entries, dir_pointer = struct.unpack('<4sii', self.file.read(12))
+			if wad_type not in [b'IWAD', b'PWAD']:
+				raise Exception('Not a valid WAD file!')
+			self.iwad = wad_type == b'IWAD'
+			self.file.seek(dir_pointer)
+			for i in range(num_entries):
+				pointer, size, name = struct.unpack('<ii8s', self.file.read(16))
+				self.directory.append((pointer, size, name.decode('ASCII').rstrip('\0')))
+			# The old directory's space can only be reused if nothing comes after it, it's allowed to be anywhere in the file
+			dir_end = dir_pointer + 16 * num_entries
+			if dir_end == self.file.seek(0, io.SEEK_END):
+				self.offset = dir_pointer
+			else:
+				self.offset = max([dir_end] + [pointer + size for pointer, size, name in self.directory])
+			# New lumps must never land on top of the old ones
+			if any(size and pointer + size > self.offset for pointer, size, name in self.directory):
+				if self.owned:
+					out.close()
+				raise Exception('Lumps overlap the WAD directory, can\'t append safely!')
+		else:
+			# Header is filled in at close
+			self.file.write(b'\0' * 12)
+			self.offset = 12
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	# Where the next lump starts, padding out to the alignment
+	def start(self, size):
+		if size and self.offset % self.align:
+			padding = self.align - self.offset % self.align
+			self.write_at(self.offset, b'\0' * padding)
+			self.offset += padding
+		return self.offset
+
+	def write_at(self, offset, data):
+		self.file.seek(offset)
+		self.file.write(data)
+
+	def add(self, name, data):
+		key = None
+		if self.dedup and data:
+			from hashlib import md5
+			key = md5(data).digest()
+			if key in self.written:
+				self.directory.append(self.written[key] + (name,))
+				return
+		pointer = self.start(len(data))
+		self.write_at(pointer, data)
+		self.offset += len(data)
+		self.directory.append((pointer, len(data), name))
+		if key:
+			self.written[key] = (pointer, len(data))
+
+	def add_marker(self, name):
+		self.add(name, b'')
+
+	# Copy a lump from a Wad, handle is (pointer, size, name) like in its wad_dir. Named after the source unless given a name
+	# Without dedup the OS copies it file to file where it can, with dedup it has to be read to compare it anyway
+	def add_lump(self, wad, handle, name=None):
+		src_pointer, size, src_name = handle
+		name = name or src_name
+		src_fd = fileno(wad.file)
+		if self.dedup and size:
+			# Same part of the same file is the same lump without reading it
+			key = None
+			if src_fd is not None:
+				stat = os.fstat(src_fd)
+				key = (stat.st_dev, stat.st_ino, src_pointer, size)
+				if key in self.written:
+					self.directory.append(self.written[key] + (name,))
+					return
+			self.add(name, self.read_lump(wad, src_fd, handle))
+			if key:
+				self.written[key] = self.directory[-1][:2]
+			return
+		pointer = self.start(size)
+		copied = False
+		if size and src_fd is not None and self.fd is not None:
+			# Anything buffered has to be out before the OS writes behind its back
+			self.file.flush()
+			copied = copy_range(src_fd, src_pointer, self.fd, pointer, size)
+		if size and not copied:
+			self.write_at(pointer, self.read_lump(wad, src_fd, handle))
+		self.offset += size
+		self.directory.append((pointer, size, name))
+
+	# Without the Wad's lock (or moving its file position) if the OS allows
+	def read_lump(self, wad, src_fd, handle):
+		pointer, size, name = handle
+		if src_fd is not None and hasattr(os, 'pread'):
+			return os.pread(src_fd, size, pointer)
+		return wad.get_data(handle)
+
+	def close(self):
+		if self.file is None:
+			return
+		buffers = [struct.pack('<ii8s', pointer, size, name.encode('ASCII')) for pointer, size, name in self.directory]
+		self.file.flush()
+		if self.fd is not None and hasattr(os, 'writev'):
+			os.lseek(self.fd, self.offset, os.SEEK_SET)
+			# Limited number of buffers per call
+			batch = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+			for i in range(0, len(buffers), batch):
+				chunk = buffers[i:i + batch]
+				written = os.writev(self.fd, chunk)
+				# Short writes are possible, finish off the rest as one
+				rest = b''.join(chunk)[written:]
+				while rest:
+					rest = rest[os.write(self.fd, rest):]
+		else:
+			self.write_at(self.offset, b''.join(buffers))
+		self.write_at(0, struct.pack('<4sii', b'IWAD' if self.iwad else b'PWAD', len(self.directory), self.offset))
+		self.file.truncate(self.offset + 16 * len(self.directory))
+		self.file.flush()
+		if self.owned:
+			self.file.close()
+		self.file = None
+
+# Writes a zip out as it goes, to a path or a binary file object. Members are either compressed here (write)
+# or already compressed by another zip and copied as they are (write_raw, see Pk3.copy_member)
+# Sizes and CRC always go in the local header, so there are no data descriptors. Zip64 records are only added where something doesn't fit
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+class ZipWriter():
+	# Minimum version to extract for each method
+	versions = {zipfile.ZIP_STORED: 20, zipfile.ZIP_DEFLATED: 20, zipfile.ZIP_BZIP2: 46, zipfile.ZIP_LZMA: 63}
+
+	def __init__(self, out):
+		import sys
+		self.owned = isinstance(out, str)
+		if self.owned:
+			out = open(out, 'wb')
+		self.file = out
+		self.offset = 0
+		# Central directory records, finished at close
+		self.entries = []
+		self.create_system = 0 if sys.platform == 'win32' else 3
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	# Compress and add data, only the methods that don't need their own headers (no LZMA)
+	def write(self, arcname, data, compress_type=zipfile.ZIP_DEFLATED, date_time=(1980, 1, 1, 0, 0, 0), external_attr=0o600 << 16):
+		import zlib
+		if compress_type == zipfile.ZIP_STORED:
+			raw = data
+		elif compress_type == zipfile.ZIP_DEFLATED:
+			compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+			raw = compressor.compress(data) + compressor.flush()
+		elif compress_type == zipfile.ZIP_BZIP2:
+			import bz2
+			raw = bz2.compress(data)
+		else:
+			raise Exception('Not a supported zip method!')
+		self.write_raw(arcname, raw, zlib.crc32(data), len(data), compress_type, date_time=date_time, external_attr=external_attr)
+
+	# Like ZipFile.write, the file's modification time and mode come along
+	def write_file(self, path, arcname=None, compress_type=zipfile.ZIP_DEFLATED):
+		import time
+		stat = os.stat(path)
+		with open(path, 'rb') as fh:
+			data = fh.read()
+		date_time = time.localtime(stat.st_mtime)[0:6]
+		arcname = os.path.normpath(arcname or path).replace(os.sep, '/').lstrip('/')
+		self.write(arcname, data, compress_type, date_time=date_time, external_attr=(stat.st_mode & 0xFFFF) << 16)
+
+	# raw is the compressed data, crc and file_size are of the uncompressed data
+	# flag_bits can keep the method's own bits (like LZMA's end of stream marker), the rest are worked out here
+	def write_raw(self, arcname, raw, crc, file_size, compress_type, flag_bits=0, date_time=(1980, 1, 1, 0, 0, 0), external_attr=0):
+		try:
+			name = arcname.encode('ascii')
+			flag_bits &= ~(0x8 | 0x800)
+		except UnicodeEncodeError:
+			name = arcname.encode('utf-8')
+			flag_bits = flag_bits & ~0x8 | 0x800
+		year, month, day, hour, minute, second = date_time
+		dosdate = (max(year, 1980) - 1980) << 9 | month << 5 | day
+		dostime = hour << 11 | minute << 5 | second // 2
+		compress_size = len(raw)
+		version = self.versions.get(compress_type, 20)
+
+		extra = b''
+		sizes = (compress_size, file_size)
+		if compress_size > zipfile.ZIP64_LIMIT or file_size > zipfile.ZIP64_LIMIT:
+			extra = struct.pack('<HHQQ', 1, 16, file_size, compress_size)
+			sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+			version = max(version, 45)
+		header = struct.pack('<4sBBHHHHLLLHH', b'PK\x03\x04', version, 0, flag_bits, compress_type, dostime, dosdate, crc, sizes[0], sizes[1], len(name), len(extra))
+		self.file.write(header + name + extra)
+		self.file.write(raw)
+		self.entries.append((name, version, flag_bits, compress_type, dostime, dosdate, crc, compress_size, file_size, external_attr, self.offset))
+		self.offset += len(header) + len(name) + len(extra) + compress_size
+
+	def close(self):
+		if self.file is None:
+			return
+		directory_offset = self.offset
+		records = []
+		for name, version, flag_bits, compress_type, dostime, dosdate, crc, compress_size, file_size, external_attr, offset in self.entries:
+			# Zip64 extra has whichever of these didn't fit, in this order
+			zip64 = []
+			if file_size > zipfile.ZIP64_LIMIT:
+				zip64.append(file_size)
+				file_size = 0xFFFFFFFF
+			if compress_size > zipfile.ZIP64_LIMIT:
+				zip64.append(compress_size)
+				compress_size = 0xFFFFFFFF
+			if offset > zipfile.ZIP64_LIMIT:
+				zip64.append(offset)
+				offset = 0xFFFFFFFF
+			extra = struct.pack('<HH' + 'Q' * len(zip64), 1, 8 * len(zip64), *zip64) if zip64 else b''
+			if zip64:
+				version = max(version, 45)
+			records.append(struct.pack('<4sBBBBHHHHLLLHHHHHLL', b'PK\x01\x02', version, self.create_system, version, 0, flag_bits, compress_type, dostime, dosdate,
+				crc, compress_size, file_size, len(name), len(extra), 0, 0, 0, external_attr, offset) + name + extra)
+		directory = b''.join(records)
+		self.file.write(directory)
+
+		count = len(self.entries)
+		directory_size = len(directory)
+		if count > 0xFFFF or directory_size > zipfile.ZIP64_LIMIT or directory_offset > zipfile.ZIP64_LIMIT:
+			end64_offset = directory_offset + directory_size
+			self.file.write(struct.pack('<4sQHHLLQQQQ', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, directory_size, directory_offset))
+			self.file.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, end64_offset, 1))
+			count = min(count, 0xFFFF)
+			directory_size = min(directory_size, 0xFFFFFFFF)
+			directory_offset = min(directory_offset, 0xFFFFFFFF)
+		self.file.write(struct.pack('<4sHHHHLLH', b'PK\x05\x06', 0, 0, count, count, directory_size, directory_offset, 0))
+		self.file.flush()
+		if self.owned:
+			self.file.close()
+		self.file = None
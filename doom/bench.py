@@ -0,0 +1,262 @@
+# Benchmarks for the hot paths of the doom package, run against synthetic fixtures since real IWADs can't be shipped
+# Cold mode starts every run with empty caches (cache_data, the patch cache and the WAD index), warm mode primes them first
+import os
+import struct
+import random
+import time
+from doom.util import cache_data
+from doom.dummy import make_picture, make_flat, make_playpal, make_dmx_pc, make_pnames, make_texturex, make_wad
+
+# Everything the benchmarks work on, size scales the number of lumps
+class Fixtures():
+	def __init__(self, path, size=1):
+		import zipfile
+		from doom.info import Palette, TextureInfo, PatchInfo
+		from doom.util import save_data
+
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+		self.playpal = make_playpal()
+		self.palette = Palette(self.playpal)
+
+		self.patch_names = ['P%05d' % i for i in range(64 * size)]
+		self.patches = [make_picture(64, 128, i) for i in range(len(self.patch_names))]
+		self.sprites = [make_picture(40, 56, 10000 + i) for i in range(256 * size)]
+		self.flats = [make_flat(i) for i in range(32 * size)]
+		self.sounds = [make_dmx_pc(140, i) for i in range(64 * size)]
+
+		r = random.Random(1)
+		self.texture_defs = []
+		for i in range(256 * size):
+			patches = [(x * 64, 0, r.randrange(len(self.patch_names))) for x in range(r.randrange(1, 4))]
+			self.texture_defs.append(('T%05d' % i, 64 * len(patches), 128, patches))
+		self.textures = []
+		for name, width, height, patches in self.texture_defs:
+			texture = TextureInfo(name, width, height, [])
+			for originx, originy, patch in patches:
+				patch_info = PatchInfo(self.patch_names[patch], originx, originy)
+				patch_info['data'] = self.patches[patch]
+				texture['patches'].append(patch_info)
+			self.textures.append(texture)
+
+		# A map in the middle, so it goes through map detection too
+		map_lumps = [('MAP01', b'')] + [(name, bytes(64)) for name in ['THINGS', 'LINEDEFS', 'SIDEDEFS', 'VERTEXES', 'SEGS', 'SSECTORS', 'NODES', 'SECTORS', 'REJECT', 'BLOCKMAP']]
+		lumps = [('PLAYPAL', self.playpal), ('PNAMES', make_pnames(self.patch_names)), ('TEXTURE1', make_texturex(self.texture_defs))]
+		lumps += map_lumps
+		lumps += [('DS%06d' % i, sound) for i, sound in enumerate(self.sounds)]
+		lumps += [('S_START', b'')] + [('S%03dA0' % i, sprite) for i, sprite in enumerate(self.sprites)] + [('S_END', b'')]
+		lumps += [('F_START', b'')] + [('F%06d' % i, flat) for i, flat in enumerate(self.flats)] + [('F_END', b'')]
+		lumps += [('P_START', b'')] + list(zip(self.patch_names, self.patches)) + [('P_END', b'')]
+		self.wad_path = os.path.join(path, 'bench.wad')
+		make_wad(self.wad_path, lumps)
+
+		self.pk3_path = os.path.join(path, 'bench.pk3')
+		with zipfile.ZipFile(self.pk3_path, 'w') as pk3:
+			pk3.writestr('playpal.lmp', self.playpal)
+			for i, sprite in enumerate(self.sprites):
+				pk3.writestr('sprites/s%03da0.lmp' % i, sprite)
+			for i, flat in enumerate(self.flats):
+				pk3.writestr('flats/f%06d.lmp' % i, flat)
+			for i, sound in enumerate(self.sounds):
+				pk3.writestr('sounds/ds%06d.lmp' % i, sound)
+			for name, patch in zip(self.patch_names, self.patches):
+				pk3.writestr('patches/' + name.lower() + '.lmp', patch)
+
+		# Same sprites from three 'IWADs', two of them share most of theirs
+		self.namespaces = []
+		for game, seed in [('doom.id.doom1', 0), ('doom.id.doom2', 0), ('doom.id.plutonia', 1)]:
+			namespace = {}
+			for i, sprite in enumerate(self.sprites):
+				data = sprite if seed == 0 or i % 2 else make_picture(40, 56, 20000 + i)
+				namespace['S%03dA0' % i] = {'name': 'S%03dA0' % i, 'data': data, 'filter': game}
+			self.namespaces.append(namespace)
+
+		# Extracted looking tree for mkzip
+		self.tree_path = os.path.join(path, 'tree')
+		for i, sprite in enumerate(self.sprites):
+			save_data(sprite, os.path.join(self.tree_path, 'sprites', 's%03da0.lmp' % i))
+		for i, sound in enumerate(self.sounds):
+			save_data(sound, os.path.join(self.tree_path, 'sounds', 'ds%06d.lmp' % i))
+
+@cache_data
+def cache_echo(data):
+	return data
+
+# Each of these takes the fixtures and returns the function to time
+
+def bench_wad_open(fixtures):
+	from doom import archive
+	# Classification is deferred until first use. Empty the WAD index cache every run, even warm, or it's all cache hits
+	def run():
+		archive.wad_index_cache.clear()
+		return archive.Wad(fixtures.wad_path).namespaced
+	return run
+
+def bench_get_wad_namespaces(fixtures):
+	from doom.archive import Wad
+	wad = Wad(fixtures.wad_path)
+	return wad.get_wad_namespaces
+
+def bench_wad_write(fixtures):
+	from doom.archive import Wad, WadWriter
+	wad = Wad(fixtures.wad_path)
+	def run():
+		with WadWriter(os.path.join(fixtures.path, 'copy.wad')) as writer:
+			for handle in wad.wad_dir:
+				writer.add_lump(wad, handle)
+	return run
+
+def bench_pk3_headers(fixtures):
+	from doom.archive import Pk3
+	pk3 = Pk3(fixtures.pk3_path)
+	return pk3.get_lump_headers
+
+def bench_picture_decode(fixtures):
+	from doom.graphic import Picture
+	def run():
+		for sprite in fixtures.sprites:
+			Picture(sprite).to_rgba(fixtures.palette)
+	return run
+
+def bench_lump_to_png(fixtures):
+	from doom.graphic import lump_to_png
+	def run():
+		for sprite in fixtures.sprites:
+			lump_to_png(sprite, fixtures.palette)
+	return run
+
+def bench_texture_to_png(fixtures):
+	from doom.graphic import texture_to_png
+	def run():
+		for texture in fixtures.textures:
+			texture_to_png(texture, fixtures.palette)
+	return run
+
+def bench_dmx_to_pcmu8(fixtures):
+	from doom.sound import Dmx
+	def run():
+		for sound in fixtures.sounds:
+			Dmx(sound).to_pcmu8()
+	return run
+
+def bench_filter_namespace(fixtures):
+	from doom.util import filter_namespace
+	from copy import copy
+	# filter_namespace changes filters in place
+	return lambda: filter_namespace([{name: copy(header) for name, header in namespace.items()} for namespace in fixtures.namespaces])
+
+def bench_mkzip(fixtures):
+	from doom.util import mkzip
+	return lambda: mkzip(os.path.join(fixtures.path, 'tree.pk3'), fixtures.tree_path)
+
+# Nothing on disk, every member is copied over from the PK3 as it is
+def bench_pk3_repack(fixtures):
+	from doom.archive import Pk3
+	from doom.util import mkzip
+	pk3 = Pk3(fixtures.pk3_path)
+	members = {header['handle']: header for header in pk3.headers()}
+	empty_path = os.path.join(fixtures.path, 'empty')
+	os.makedirs(empty_path, exist_ok=True)
+	return lambda: mkzip(os.path.join(fixtures.path, 'repack.pk3'), empty_path, members=members)
+
+def bench_cache_data(fixtures):
+	blobs = [struct.pack('<I', i) * 1024 for i in range(512)]
+	def run():
+		for blob in blobs:
+			cache_echo(blob)
+	return run
+
+benchmarks = [
+	('wad_open', bench_wad_open),
+	('get_wad_namespaces', bench_get_wad_namespaces),
+	('wad_write', bench_wad_write),
+	('pk3_headers', bench_pk3_headers),
+	('picture_decode', bench_picture_decode),
+	('lump_to_png', bench_lump_to_png),
+	('texture_to_png', bench_texture_to_png),
+	('dmx_to_pcmu8', bench_dmx_to_pcmu8),
+	('filter_namespace', bench_filter_namespace),
+	('mkzip', bench_mkzip),
+	('pk3_repack', bench_pk3_repack),
+	('cache_data', bench_cache_data),
+]
+
+# Empty out everything cached between runs
+def clear_caches(cache_path):
+	from shutil import rmtree
+	from doom import graphic, archive
+	rmtree(cache_path, ignore_errors=True)
+	graphic.patch_cache.clear()
+	archive.wad_index_cache.clear()
+
+# Returns results as a dict ready for json, times are in seconds
+def run(mode='warm', repeat=5, size=1, only=None, path=None):
+	import platform
+	import statistics
+	from tempfile import mkdtemp
+	from shutil import rmtree
+
+	if mode not in ['cold', 'warm']:
+		raise Exception('Mode must be cold or warm!')
+
+	work_path = path or mkdtemp(prefix='wadsnip_bench_')
+	old_cache_path = cache_data.path
+	cache_data.path = os.path.join(work_path, '_cache')
+	try:
+		print('Building fixtures...')
+		fixtures = Fixtures(os.path.join(work_path, 'fixtures'), size)
+
+		results = {}
+		for name, setup in benchmarks:
+			if only and name not in only:
+				continue
+			clear_caches(cache_data.path)
+			func = setup(fixtures)
+			if mode == 'warm':
+				func()
+			times = []
+			for i in range(repeat):
+				if mode == 'cold':
+					clear_caches(cache_data.path)
+				start = time.perf_counter()
+				func()
+				times.append(time.perf_counter() - start)
+			results[name] = {
+				'times': times,
+				'min': min(times),
+				'median': statistics.median(times),
+				'mean': statistics.mean(times),
+			}
+			print(f'{name:<20} {results[name]["median"] * 1000:10.2f} ms')
+	finally:
+		cache_data.path = old_cache_path
+		if not path:
+			rmtree(work_path, ignore_errors=True)
+
+	return {
+		'mode': mode,
+		'size': size,
+		'repeat': repeat,
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'results': results,
+	}
+
+# Median time against the baseline for every benchmark in both, anything slower by more than threshold is a regression
+# Returns a list of (name, baseline, current, ratio) for the regressions
+def compare(current, baseline, threshold=0.1):
+	if current['mode'] != baseline['mode'] or current['size'] != baseline['size']:
+		print(f'WARNING: Comparing {current["mode"]} size {current["size"]} against {baseline["mode"]} size {baseline["size"]}!')
+	regressions = []
+	for name, result in current['results'].items():
+		if name not in baseline['results']:
+			continue
+		before = baseline['results'][name]['median']
+		after = result['median']
+		ratio = after / before if before else float('inf')
+		flag = ''
+		if ratio > 1 + threshold:
+			flag = ' REGRESSION'
+			regressions.append((name, before, after, ratio))
+		print(f'{name:<20} {before * 1000:10.2f} ms -> {after * 1000:10.2f} ms {ratio:6.2f}x{flag}')
+	return regressions
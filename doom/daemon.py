@@ -0,0 +1,129 @@
+# Long running server for the scripts, so repeated runs (like the Makefile's) skip the warm up
+# Imports, WAD classification, waifu2x models and recently cached data all stay loaded between jobs
+# Jobs are the scripts themselves run with runpy from the client's working directory, one at a time since they chdir and print
+# Protocol is JSON lines over a Unix socket: the client sends {'script', 'argv', 'cwd'}, the server answers with {'out': text} as it goes and {'exit': code} at the end
+import io
+import os
+import sys
+import json
+import socket
+import runpy
+import signal
+import traceback
+import socketserver
+from threading import Lock
+
+# Only these get run, from the directory above doom
+scripts = ['extract.py', 'hires.py', 'bleeps.py', 'smoosh.py']
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+job_lock = Lock()
+
+# Sends everything written to it to the client as it comes
+class ClientWriter(io.TextIOBase):
+	def __init__(self, wfile):
+		self.wfile = wfile
+
+	def writable(self):
+		return True
+
+	def write(self, text):
+		if text:
+			send(self.wfile, {'out': text})
+		return len(text)
+
+def send(wfile, message):
+	wfile.write(json.dumps(message).encode() + b'\n')
+	wfile.flush()
+
+def run_job(job, out):
+	from contextlib import redirect_stdout, redirect_stderr
+	from doom import timing
+
+	script = os.path.basename(job['script'])
+	if script not in scripts:
+		print('Daemon can\'t run ' + script + '!', file=out)
+		return 1
+	old_cwd = os.getcwd()
+	old_argv = sys.argv
+	try:
+		os.chdir(job['cwd'])
+		sys.argv = [script] + job['argv']
+		with redirect_stdout(out), redirect_stderr(out):
+			runpy.run_path(os.path.join(root, script), run_name='__main__')
+		return 0
+	except SystemExit as e:
+		if e.code is None or isinstance(e.code, int):
+			return e.code or 0
+		print(e.code, file=out)
+		return 1
+	except Exception:
+		traceback.print_exc(file=out)
+		return 1
+	finally:
+		os.chdir(old_cwd)
+		sys.argv = old_argv
+		# --profile is per job
+		timing.enabled = False
+		timing.reset()
+
+class JobHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		try:
+			job = json.loads(self.rfile.readline())
+		except ValueError:
+			return
+		with job_lock:
+			print('Running: ' + ' '.join([job['script']] + job['argv']))
+			code = run_job(job, ClientWriter(self.wfile))
+		send(self.wfile, {'exit': code})
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+# memory is how many MB of cache_data results to keep in memory
+def serve(socket_path, memory=512):
+	from doom.util import cache_data, MemoryCache
+	import multiprocessing as mp
+	from importlib import import_module
+
+	cache_data.memory = MemoryCache(memory * 2 ** 20)
+	# Forking a process full of threads and loaded models is asking for trouble, and it's what hires wants anyway
+	mp.set_start_method('spawn', force=True)
+	# Warm up the usual imports before the first job, whichever of them have their dependencies installed
+	for module in ['doom.graphic', 'doom.sound', 'doom.music', 'doom.info']:
+		try:
+			import_module(module)
+		except ImportError:
+			pass
+
+	if os.path.exists(socket_path):
+		os.remove(socket_path)
+	server = Daemon(socket_path, JobHandler)
+	os.chmod(socket_path, 0o600)
+	# Clean up the socket on kill as well as Ctrl-C
+	signal.signal(signal.SIGTERM, signal.default_int_handler)
+	print('Listening on: ' + socket_path)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.remove(socket_path)
+
+# Client side, returns the exit code of the job
+def submit(socket_path, script, argv):
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.connect(socket_path)
+	with client, client.makefile('rwb') as stream:
+		send(stream, {'script': os.path.basename(script), 'argv': argv, 'cwd': os.getcwd()})
+		for line in stream:
+			message = json.loads(line)
+			if 'out' in message:
+				sys.stdout.write(message['out'])
+				sys.stdout.flush()
+			elif 'exit' in message:
+				return message['exit']
+	print('Lost the daemon before the job finished!')
+	return 1
@@ -0,0 +1,214 @@
+# Dummy IWADs, PWADs and PK3s for testing at scale without shipping the real (copyrighted) ones
+# Everything is valid enough for the rest of the doom package to read: marker namespaces, PNAMES/TEXTURE1, Picture format graphics, DMX sounds, MUS, maps and nested subarchives
+# Lump contents are random noise, seeded so the same arguments always give the same archive
+import io
+import os
+import struct
+import random
+import zipfile
+
+# Doom picture format, one post per column at a random height
+def make_picture(width, height, seed=0):
+	r = random.Random(seed)
+	columns = []
+	for x in range(width):
+		top = r.randrange(0, height)
+		length = r.randrange(1, min(height - top, 254) + 1)
+		columns.append(bytes([top, length, 0]) + r.randbytes(length) + b'\0\xff')
+	header = struct.pack('<HHhh', width, height, width // 2, height - 4)
+	offset = 8 + 4 * width
+	table = b''
+	for column in columns:
+		table += struct.pack('<I', offset)
+		offset += len(column)
+	return header + table + b''.join(columns)
+
+def make_flat(seed=0):
+	return random.Random(seed).randbytes(64 * 64)
+
+def make_playpal(seed=0):
+	return random.Random(seed).randbytes(256 * 3) * 14
+
+def make_colormap(seed=0):
+	return random.Random(seed).randbytes(256) * 34
+
+# https://doomwiki.org/wiki/Sound
+def make_dmx_pc(length, seed=0):
+	r = random.Random(seed)
+	return struct.pack('<HH', 0, length) + bytes(r.randrange(0, 96) if r.random() > 0.2 else 0 for _ in range(length))
+
+def make_dmx_digital(length, samplerate=11025, seed=0):
+	return struct.pack('<HHI', 3, samplerate, length + 32) + b'\x80' * 16 + random.Random(seed).randbytes(length) + b'\x80' * 16
+
+# https://doomwiki.org/wiki/MUS
+# A few notes on the first channel, each held for a random number of ticks
+def make_mus(notes=16, seed=0):
+	r = random.Random(seed)
+	score = b''
+	for i in range(notes):
+		note = r.randrange(40, 80)
+		# Press with volume, then release, both with the 'last' bit set so a delay follows
+		score += bytes([0x90, note | 0x80, 100, r.randrange(1, 0x80)])
+		score += bytes([0x80, note, r.randrange(1, 0x80)])
+	score += bytes([0x60])
+	instruments = [0]
+	score_start = 16 + 2 * len(instruments)
+	return struct.pack('<4sHHHHHH', b'MUS\x1A', len(score), score_start, 1, 0, len(instruments), 0) + struct.pack('<' + 'H' * len(instruments), *instruments) + score
+
+def make_pnames(names):
+	return struct.pack('<I', len(names)) + b''.join(name.encode('ASCII').ljust(8, b'\0') for name in names)
+
+# Doom format TEXTURE1, textures are (name, width, height, [(originx, originy, patch index)])
+def make_texturex(textures):
+	offset = 4 + 4 * len(textures)
+	offsets = b''
+	body = b''
+	for name, width, height, patches in textures:
+		offsets += struct.pack('<i', offset + len(body))
+		body += struct.pack('<8sIhhIh', name.encode('ASCII'), 0, width, height, 0, len(patches))
+		for originx, originy, patch in patches:
+			body += struct.pack('<hhhhh', originx, originy, patch, 1, 0)
+	return struct.pack('<i', len(textures)) + offsets + body
+
+# Record sizes of the Doom format map lumps, https://doomwiki.org/wiki/Map_format
+map_records = [('THINGS', 10), ('LINEDEFS', 14), ('SIDEDEFS', 30), ('VERTEXES', 4), ('SEGS', 12), ('SSECTORS', 4), ('NODES', 28), ('SECTORS', 26), ('REJECT', 1), ('BLOCKMAP', 2)]
+
+# Doom format map as a list of (name, data), starting with its header
+def make_map(name, records=64, seed=0):
+	r = random.Random(seed)
+	return [(name, b'')] + [(lump, r.randbytes(size * records)) for lump, size in map_records]
+
+# lumps are (name, data)
+def make_wad_data(lumps, iwad=True):
+	out_file = io.BytesIO()
+	out_file.write(struct.pack('<4sii', b'IWAD' if iwad else b'PWAD', len(lumps), 12 + sum(len(data) for name, data in lumps)))
+	directory = []
+	for name, data in lumps:
+		directory.append(struct.pack('<ii8s', out_file.tell(), len(data), name.encode('ASCII')))
+		out_file.write(data)
+	out_file.write(b''.join(directory))
+	return out_file.getvalue()
+
+def make_wad(path, lumps, iwad=True):
+	from doom.util import save_data
+	save_data(make_wad_data(lumps, iwad), path)
+
+# Names are a prefix and suffix around a base 36 count, padded out to the full 8 characters
+def lump_name(prefix, i, suffix=''):
+	digits = ''
+	while i or not digits:
+		i, digit = divmod(i, 36)
+		digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'[digit] + digits
+	width = 8 - len(prefix) - len(suffix)
+	if len(digits) > width:
+		raise Exception('Too many lumps to name with ' + prefix + '!')
+	return prefix + digits.rjust(width, '0') + suffix
+
+# Marker namespaces in a WAD, and their folder in a PK3
+dummy_markers = {'sprites': 'S', 'flats': 'F', 'patches': 'P'}
+
+# Roughly how the lumps of a dummy are divided up, whatever is left over goes to sprites
+dummy_shares = {'patches': 0.15, 'flats': 0.1, 'sounds': 0.25, 'music': 0.05}
+
+# Lumps for a dummy as (namespace, name, data), in WAD order. Maps are in the 'maps' namespace with a list of (name, data) lumps as their data
+# lumps is roughly how many lumps the WAD version ends up with, maps take 11 each
+# Dummies made with different seeds have different data under the same names, except for the 'shared' fraction of them that stays the same, like the graphics most IWADs have in common
+def dummy_lumps(lumps=1000, textures=None, maps=None, seed=0, shared=0.0, picture_size=(32, 32)):
+	if maps is None:
+		maps = max(1, lumps // 1000)
+	# Globals and markers
+	left = max(0, lumps - 4 - 2 * len(dummy_markers) - 11 * maps)
+	counts = {ns: int(left * share) for ns, share in dummy_shares.items()}
+	# Sounds come in digital and PC speaker pairs
+	counts['sounds'] -= counts['sounds'] % 2
+	counts['sprites'] = left - sum(counts.values())
+	if textures is None:
+		textures = counts['patches']
+
+	# Golden ratio spacing picks out the shared lumps evenly, and the same ones for any seed
+	def content_seed(ns, i):
+		if (i * 0.6180339887) % 1 < shared:
+			return f'0/{ns}/{i}'
+		return f'{seed}/{ns}/{i}'
+
+	width, height = picture_size
+	patch_names = [lump_name('P', i) for i in range(counts['patches'])]
+	r = random.Random(f'{seed}/textures')
+	texture_defs = []
+	if patch_names:
+		for i in range(textures):
+			patches = [(x * width, 0, r.randrange(len(patch_names))) for x in range(r.randrange(1, 4))]
+			texture_defs.append((lump_name('T', i), width * len(patches), height, patches))
+
+	entries = [
+		('global', 'PLAYPAL', make_playpal(content_seed('global', 0))),
+		('global', 'COLORMAP', make_colormap(content_seed('global', 1))),
+		('global', 'PNAMES', make_pnames(patch_names)),
+		('global', 'TEXTURE1', make_texturex(texture_defs)),
+	]
+	entries += [('maps', 'MAP%02d' % (i + 1), make_map('MAP%02d' % (i + 1), seed=content_seed('maps', i))) for i in range(maps)]
+	for i in range(counts['sounds'] // 2):
+		entries.append(('sounds', lump_name('DS', i), make_dmx_digital(256, seed=content_seed('sounds', i))))
+		entries.append(('sounds', lump_name('DP', i), make_dmx_pc(64, seed=content_seed('sounds_pc', i))))
+	entries += [('music', lump_name('D_', i), make_mus(seed=content_seed('music', i))) for i in range(counts['music'])]
+	entries += [('sprites', lump_name('S', i, 'A0'), make_picture(width, height, content_seed('sprites', i))) for i in range(counts['sprites'])]
+	entries += [('flats', lump_name('F', i), make_flat(content_seed('flats', i))) for i in range(counts['flats'])]
+	entries += [('patches', name, make_picture(width, height, content_seed('patches', i))) for i, name in enumerate(patch_names)]
+	return entries
+
+# Flatten dummy_lumps into WAD lumps, marker namespaces get their markers
+def dummy_wad_lumps(entries):
+	lumps = []
+	marked = {}
+	for namespace, name, data in entries:
+		if namespace == 'maps':
+			lumps += data
+		elif namespace in dummy_markers:
+			marked.setdefault(namespace, []).append((name, data))
+		else:
+			lumps.append((name, data))
+	for namespace, marker in dummy_markers.items():
+		lumps += [(marker + '_START', b'')] + marked.get(namespace, []) + [(marker + '_END', b'')]
+	return lumps
+
+# Same thing as PK3 members (path, data), maps become their own WADs
+def dummy_pk3_members(entries):
+	members = []
+	for namespace, name, data in entries:
+		if namespace == 'maps':
+			members.append(('maps/' + name.lower() + '.wad', make_wad_data(data, iwad=False)))
+		elif namespace == 'global':
+			members.append((name.lower() + '.lmp', data))
+		else:
+			members.append((namespace + '/' + name.lower() + '.lmp', data))
+	return members
+
+# Write a dummy to path, a WAD or a PK3 going by the extension (.wad/.iwad, anything else is a PK3)
+# A PK3 gets 'nested' subarchives in it as well, alternating between WADs and PK3s, each with 'nested_lumps' of their own
+# Returns the entries from dummy_lumps
+def dummy(path, lumps=1000, textures=None, maps=None, nested=0, nested_lumps=100, seed=0, shared=0.0, iwad=True, picture_size=(32, 32)):
+	from doom.util import save_data
+	entries = dummy_lumps(lumps, textures, maps, seed, shared, picture_size)
+	if os.path.splitext(path)[1].lower() in ['.wad', '.iwad']:
+		save_data(make_wad_data(dummy_wad_lumps(entries), iwad), path)
+		return entries
+
+	members = dummy_pk3_members(entries)
+	for i in range(nested):
+		# No maps or globals in these, just more lumps for the parent to pick up
+		nested_entries = [entry for entry in dummy_lumps(nested_lumps, maps=0, seed=f'{seed}/nested{i}', picture_size=picture_size) if entry[0] != 'global']
+		if i % 2 == 0:
+			members.append(('nested%d.wad' % i, make_wad_data(dummy_wad_lumps(nested_entries), iwad=False)))
+		else:
+			nested_file = io.BytesIO()
+			with zipfile.ZipFile(nested_file, 'w') as pk3:
+				for name, data in dummy_pk3_members(nested_entries):
+					pk3.writestr(name, data)
+			members.append(('nested%d.pk3' % i, nested_file.getvalue()))
+	dirpath = os.path.dirname(path)
+	if dirpath:
+		os.makedirs(dirpath, exist_ok=True)
+	with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as pk3:
+		for name, data in members:
+			pk3.writestr(name, data)
+	return entries
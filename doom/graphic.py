@@ -3,48 +3,88 @@ import struct
 import os
 import sys
 from doom.util import cache_data, save_data, load_data
-from PIL import Image, ImageOps
+from doom import timing
 
 @cache_data
 def lump_to_png(lump_data, palette):
 	return ZImage(lump_data, palette).to_png()
 
-@cache_data
-def texture_to_png(textureinfo, palette):
+# Decoded patches as RGBA arrays by (patch digest, palette digest), the same patches show up in a lot of textures
+patch_cache = {}
+patch_cache_max = 4096
+
+def patch_to_rgba(data, palette):
+	import hashlib
+	import numpy as np
+	key = (hashlib.md5(data).digest(), palette.digest if palette else None)
+	rgba = patch_cache.get(key)
+	if rgba is None:
+		if len(patch_cache) >= patch_cache_max:
+			patch_cache.clear()
+		zimg = ZImage(data, palette)
+		rgba = np.frombuffer(zimg.tobytes(), dtype=np.uint8).reshape(zimg.height, zimg.width, 4)
+		patch_cache[key] = rgba
+	return rgba
+
+# Same as PIL's paste with the patch as its own mask, every channel is blended by the patch alpha
+# Anything hanging off the canvas is clipped
+def blit(canvas, rgba, x, y):
+	import numpy as np
+	height, width = rgba.shape[:2]
+	left, top = max(x, 0), max(y, 0)
+	right, bottom = min(x + width, canvas.shape[1]), min(y + height, canvas.shape[0])
+	if left >= right or top >= bottom:
+		return
+	src = rgba[top - y:bottom - y, left - x:right - x].astype(np.uint16)
+	dst = canvas[top:bottom, left:right]
+	alpha = src[..., 3:]
+	# (dst * (255 - alpha) + src * alpha) / 255, rounded the way PIL does it
+	blended = dst * (255 - alpha) + src * alpha + 128
+	dst[...] = (blended + (blended >> 8)) >> 8
+
+# Composite a texture onto a (height, width, 4) RGBA array
+def texture_to_rgba(textureinfo, palette):
+	import numpy as np
 	# TODO: Render all the crazy options correctly instead of simply ignoring them
-	img = Image.new('RGBA', (textureinfo['width'], textureinfo['height']), (0, 0, 0, 0))
-	
+	canvas = np.zeros((textureinfo['height'], textureinfo['width'], 4), dtype=np.uint8)
 	for patch in textureinfo['patches']:
-		patch_img = ZImage(patch['data'], palette)
-		img.paste(patch_img, box=(patch['xorigin'], patch['yorigin']), mask=patch_img)
-	
+		blit(canvas, patch_to_rgba(patch['data'], palette), patch['xorigin'], patch['yorigin'])
+	return canvas
+
+@cache_data
+def texture_to_png(textureinfo, palette):
+	from PIL import Image
+	canvas = texture_to_rgba(textureinfo, palette)
+	img = Image.frombytes('RGBA', (textureinfo['width'], textureinfo['height']), canvas.tobytes())
 	zimg = ZImage(img, palette)
 	return zimg.to_png()
 
 # Not caching, because this function could probably be tweaked until the end of time.
 # TODO: Perhaps increase the canvas for both xbrz and waifu, and return back a corrected offset - this would necessitate the use of TEXTURES to define all graphics
 # Would also run into namepace issues that way
+@timing.timed()
 def superscale(texture):
 	png_data = texture['data']
 	scale = texture['scale']
 
-	# TODO: Increase canvas size for XBRZ, but crop it down to minimum size and keep that size
-	texture['XScale'] *= scale
-	texture['YScale'] *= scale
-	texture['width']  *= scale
-	texture['height'] *= scale
-	texture['Offset'] = tuple(i * scale for i in texture['Offset'])
-	if texture['namespace'].lower() in ['walltexture', 'texture']:
-		texture['WorldPanning'] = True
+	superscale_info(texture)
 
 	print('Processing ' + texture['name'].upper())
 
+	tile = superscale_tile(png_data, scale)
+	if tile:
+		texture['data'] = tiled_scale(png_data, scale, superscale_data, tile, superscale.settings['overlap'])
+	else:
+		texture['data'] = superscale_data(png_data, scale)
+	return texture
+
+def superscale_data(png_data, scale):
 	# UpResNet10 is slightly blurrier, less weird sharp details. Might be better for wall textures in some instances?
-	method = 'ResNet10' 
+	method = superscale.settings['method']
 	# For sprites, just cache scales with as much pixel info as possible, then cut it out with xbrz
-	waifu_thresh = 0
+	waifu_thresh = superscale.settings['waifu_thresh']
 	# Arbitrary value to get rid of alpha blending from xbrz. Halfway seems like a reasonable value.
-	xbrz_thresh = 128
+	xbrz_thresh = superscale.settings['xbrz_thresh']
 	
 	if has_transparency(png_data):
 		# Scale using xbrz, but only to grab its alpha layer to use as a mask on waifu2x
@@ -56,13 +96,144 @@ def superscale(texture):
 
 		png_img = data_to_image(png_data)
 		png_img.putalpha(xbrz_img.split()[-1])
-		png_data = image_to_data(png_img)
-		texture['data'] = png_data
-		return texture
+		return image_to_data(png_img)
 	else:
-		png_data = waifu_scale(png_data, scale, waifu_thresh, method)
-		texture['data'] = png_data
-		return texture
+		return waifu_scale(png_data, scale, waifu_thresh, method)
+
+# Anything that changes how superscale turns out, for incremental hires builds to compare against
+# memory is the peak (in MB) to aim for while scaling one image, anything bigger is scaled in tiles overlapping by 'overlap' pixels
+superscale.settings = {'method': 'ResNet10', 'waifu_thresh': 0, 'xbrz_thresh': 128, 'memory': None, 'overlap': 8}
+
+# Rough bytes held per output pixel while scaling: waifu2x works in float32, plus the xbrz mask and PIL copies along the way
+scale_bytes_per_pixel = 48
+# Tiled output is blended in float32 (RGBA and a weight) a strip at a time
+tile_bytes_per_pixel = 20
+
+# Source tile size that keeps scaling under the memory setting, None if the image fits as is
+def superscale_tile(png_data, scale):
+	memory = superscale.settings['memory']
+	if not memory:
+		return None
+	budget = memory * 1024 * 1024
+	overlap = superscale.settings['overlap']
+	width, height = data_to_image(png_data).size
+	if width * height * scale * scale * scale_bytes_per_pixel <= budget:
+		return None
+	tile = max(width, height)
+	while tile > max(16, overlap * 2):
+		padded = (tile + overlap * 2) * scale
+		if padded * padded * scale_bytes_per_pixel + width * scale * padded * tile_bytes_per_pixel <= budget:
+			break
+		tile //= 2
+	return max(tile, 16, overlap * 2)
+
+# Scale an image a tile at a time, with scaler(png_data, scale) doing the scaling of each tile
+# Tiles overlap by 'overlap' source pixels on every side and are cross faded over the overlap to hide the seams.
+# Output rows are encoded as soon as no more tiles touch them, so only a strip of the scaled image is ever in memory
+def tiled_scale(png_data, scale, scaler, tile, overlap):
+	from PIL import Image
+	import numpy as np
+	src = data_to_image(png_data).convert('RGBA')
+	width, height = src.size
+	
+	# Tile extents (with overlap) along one axis
+	def spans(size):
+		return [(max(0, start - overlap), min(size, start + tile + overlap)) for start in range(0, size, tile)]
+	
+	# Output weight along one axis, ramping across whatever is shared with the tiles before and after
+	def ramp(spans, i):
+		start, end = spans[i]
+		weight = np.ones((end - start) * scale, dtype=np.float32)
+		if i > 0 and spans[i - 1][1] > start:
+			shared = (spans[i - 1][1] - start) * scale
+			weight[:shared] *= (np.arange(shared, dtype=np.float32) + 0.5) / shared
+		if i + 1 < len(spans) and spans[i + 1][0] < end:
+			shared = (end - spans[i + 1][0]) * scale
+			weight[-shared:] *= (np.arange(shared, 0, -1, dtype=np.float32) - 0.5) / shared
+		return weight
+	
+	columns = spans(width)
+	rows = spans(height)
+	strip = max(bottom - top for top, bottom in rows) * scale
+	with io.BytesIO() as png:
+		writer = PngWriter(png, width * scale, height * scale)
+		# Accumulated color * weight and weight, starting from output row 'flushed'
+		flushed = 0
+		color = np.zeros((strip, width * scale, 4), dtype=np.float32)
+		weight = np.zeros((strip, width * scale, 1), dtype=np.float32)
+		for row, (top, bottom) in enumerate(rows):
+			row_ramp = ramp(rows, row)
+			y = top * scale - flushed
+			for column, (left, right) in enumerate(columns):
+				scaled = data_to_image(scaler(image_to_data(src.crop((left, top, right, bottom))), scale)).convert('RGBA')
+				size = ((right - left) * scale, (bottom - top) * scale)
+				if scaled.size != size:
+					scaled = scaled.resize(size, Image.BICUBIC)
+				tile_weight = (row_ramp[:, None] * ramp(columns, column)[None, :])[..., None]
+				color[y:y + size[1], left * scale:right * scale] += np.asarray(scaled, dtype=np.float32) * tile_weight
+				weight[y:y + size[1], left * scale:right * scale] += tile_weight
+			# Rows above the next row of tiles are done, a few at a time to keep temporaries small
+			done = (rows[row + 1][0] * scale if row + 1 < len(rows) else height * scale) - flushed
+			for i in range(0, done, 16):
+				j = min(i + 16, done)
+				writer.write(np.clip(np.rint(color[i:j] / weight[i:j]), 0, 255).astype(np.uint8))
+			# Shift what is left up to the start
+			left_over = y + (bottom - top) * scale - done
+			color[:left_over] = color[done:done + left_over]
+			weight[:left_over] = weight[done:done + left_over]
+			color[left_over:] = 0
+			weight[left_over:] = 0
+			flushed += done
+		writer.close()
+		return png.getvalue()
+
+# Writes an RGBA PNG a few rows at a time, so the whole image never has to be held uncompressed
+# Every row uses the 'Up' filter
+class PngWriter():
+	def __init__(self, fh, width, height, level=6):
+		import zlib
+		self.fh = fh
+		self.width = width
+		self.compressor = zlib.compressobj(level)
+		self.previous = None
+		fh.write(b'\x89PNG\r\n\x1a\n')
+		self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+	
+	def chunk(self, name, data):
+		import zlib
+		self.fh.write(struct.pack('>I', len(data)) + name + data + struct.pack('>I', zlib.crc32(name + data) & 0xffffffff))
+	
+	# (rows, width, 4) uint8
+	def write(self, rgba):
+		import numpy as np
+		if not len(rgba):
+			return
+		rgba = rgba.reshape(len(rgba), self.width * 4)
+		previous = np.concatenate([self.previous if self.previous is not None else np.zeros((1, self.width * 4), dtype=np.uint8), rgba[:-1]])
+		filtered = np.empty((len(rgba), self.width * 4 + 1), dtype=np.uint8)
+		filtered[:, 0] = 2
+		filtered[:, 1:] = rgba - previous
+		self.previous = rgba[-1:].copy()
+		data = self.compressor.compress(filtered.tobytes())
+		if data:
+			self.chunk(b'IDAT', data)
+	
+	def close(self):
+		self.chunk(b'IDAT', self.compressor.flush())
+		self.chunk(b'IEND', b'')
+
+# The texture definition side of superscale, without touching the image
+def superscale_info(texture):
+	scale = texture['scale']
+	# TODO: Increase canvas size for XBRZ, but crop it down to minimum size and keep that size
+	texture['XScale'] *= scale
+	texture['YScale'] *= scale
+	texture['width']  *= scale
+	texture['height'] *= scale
+	texture['Offset'] = tuple(i * scale for i in texture['Offset'])
+	if texture['namespace'].lower() in ['walltexture', 'texture']:
+		texture['WorldPanning'] = True
+	return texture
 
 @cache_data
 def waifu_scale(png_data, scale, waifu_thresh, method):
@@ -83,6 +254,7 @@ def waifu_scale(png_data, scale, waifu_thresh, method):
 
 @cache_data
 def xbrz_scale(xbrz_data, scale, xbrz_thresh):
+	from PIL import ImageOps
 	# xbrz only allows scaling 2x-6x
 	xbrz_scales = {
 		2:  [2],
@@ -126,7 +298,11 @@ class HiddenPrints:
         sys.stdout.close()
         sys.stdout = self._original_stdout
 
+# Loaded waifu2x models by (method, arch, color, gpu)
+waifu2x_models = {}
+
 @cache_data
+@timing.timed('waifu2x')
 def png_to_waifu2x(data, method, arch, color):
 	import sys
 	import os
@@ -150,7 +326,11 @@ def png_to_waifu2x(data, method, arch, color):
 	cfg.gpu = png_to_waifu2x.gpu
 	cfg.model_dir = os.path.join('waifu2x_chainer','models',cfg.arch.lower())
 	
-	models = waifu2x.load_models(cfg)
+	# Loading is slow, keep them around for the next image (and the next job on a daemon)
+	key = (cfg.method, cfg.arch, cfg.color, cfg.gpu)
+	if key not in waifu2x_models:
+		waifu2x_models[key] = waifu2x.load_models(cfg)
+	models = waifu2x_models[key]
 	
 	src = data_to_image(data)
 	# Can get out of memory errors if cuda is multiprocessed
@@ -165,6 +345,7 @@ def png_to_waifu2x(data, method, arch, color):
 	return image_to_data(dst)
 
 @cache_data
+@timing.timed()
 def xbrz(src_data, scale):
 	from subprocess import call
 	from os.path import join
@@ -184,6 +365,7 @@ def xbrz(src_data, scale):
 # These methods evaluate the alpha channel values and choose a pivot point to make them full transparent or opaque (More like original Doom pictures anyway)
 # Too high a pivot is restrictive and results in staircased edges, too low results in additional 'islands' of pixels outside the main sprite
 def alpha_threshold_pixelcount(src_data, dst_data):
+	from PIL import Image
 	def alpha_pivot(alpha, pivot):
 		return Image.eval(alpha, lambda px: 255 if px > pivot else 0)
 	def count_pixels(image):
@@ -219,6 +401,7 @@ def alpha_threshold_pixelcount(src_data, dst_data):
 	return image_to_data(dst)
 
 def alpha_threshold_islands(src_data, dst_data):
+	from PIL import Image
 	import numpy as np
 	from scipy import ndimage
 
@@ -246,6 +429,7 @@ def alpha_threshold_islands(src_data, dst_data):
 	return image_to_data(dst)
 
 def alpha_threshold(dst, pivot):
+	from PIL import Image
 	def alpha_pivot(alpha, pivot):
 			return Image.eval(alpha, lambda px: 255 if px > pivot else 0)
 
@@ -270,12 +454,53 @@ def image_to_data(image):
 		return ret
 
 def data_to_image(data):
+	from PIL import Image
 	with io.BytesIO(data) as in_io:
 		in_io.seek(0)
 		image = Image.open(in_io)
 		image.load()
 		return image
 
+# Canonical digest of what an image looks like, regardless of how it was encoded
+# Size and offsets count, since they change where it ends up in game
+def pixel_digest(width, height, rgba, offset=(0, 0)):
+	import hashlib
+	m = hashlib.md5(struct.pack('<IIii', width, height, *(int(i) for i in offset)))
+	m.update(rgba)
+	return m.digest()
+
+# Pixel digest and perceptual hash of a decoded (height, width, 4) RGBA array
+def rgba_digests(rgba, offset=(0, 0)):
+	return pixel_digest(rgba.shape[1], rgba.shape[0], rgba.tobytes(), offset), rgba_dhash(rgba)
+
+def image_to_rgba(data, palette=None):
+	import numpy as np
+	zimg = ZImage(data, palette)
+	return np.asarray(zimg.convert('RGBA'))
+
+def image_pixel_digest(data, offset=(0, 0)):
+	rgba = image_to_rgba(data)
+	return pixel_digest(rgba.shape[1], rgba.shape[0], rgba.tobytes(), offset)
+
+# Perceptual (difference) hash as a 64 bit int, images that look about the same have hashes a few bits apart
+# Colors are weighted by alpha so that changes to the outline of a sprite show up too
+def rgba_dhash(rgba, size=8):
+	from PIL import Image
+	import numpy as np
+	rgba = rgba.astype(np.uint32)
+	gray = (rgba[..., 0] * 299 + rgba[..., 1] * 587 + rgba[..., 2] * 114) * rgba[..., 3] // (1000 * 255)
+	small = np.asarray(Image.fromarray(gray.astype(np.uint8)).resize((size + 1, size), Image.BILINEAR), dtype=np.int16)
+	dhash = 0
+	for bit in (small[:, 1:] > small[:, :-1]).flatten():
+		dhash = (dhash << 1) | int(bit)
+	return dhash
+
+def image_dhash(data, size=8):
+	return rgba_dhash(image_to_rgba(data), size)
+
+def hash_distance(a, b):
+	return bin(a ^ b).count('1')
+
 class PictureSanity(Exception):
 	pass
 
@@ -340,22 +565,25 @@ class Picture():
 		self.columns = columns
 	
 	def to_rgba(self, palette):
+		import numpy as np
+		# Gather up where each post pixel goes, then look them all up in the palette at once
 		# Zeros will init as transparent pixels
-		rgba = io.BytesIO(b'\0' * self.width * self.height * 4)
+		positions = []
+		entries = []
 		for column in self.columns:
+			x = column['index']
 			for post in column['posts']:
 				topdelta = post['topdelta']
-				for entry in post['data']:
-					# TODO: I think all this seeking is hilariously inefficient, should find a way to make this better. Though with caching it hardly matters.
-					rgba.seek(topdelta * (self.width * 4) + (column['index'] * 4))
-					r, g, b = palette[entry]
-					rgba.write(struct.pack('BBBB', r, g, b, 255))
-					topdelta += 1
-		rgba_bytes = rgba.getvalue()
-		rgba.close()
-		return rgba_bytes
+				# Anything running off the bottom is dropped
+				data = post['data'][:max(0, self.height - topdelta)]
+				positions.extend(range(topdelta * self.width + x, (topdelta + len(data)) * self.width + x, self.width))
+				entries.extend(data)
+		rgba = np.zeros((self.width * self.height, 4), dtype=np.uint8)
+		rgba[np.array(positions, dtype=np.int64)] = palette.rgba()[np.array(entries, dtype=np.uint8)]
+		return rgba.tobytes()
 	
 	def to_image(self, palette):
+		from PIL import Image
 		return Image.frombytes('RGBA', (self.width, self.height), self.to_rgba(palette))
 
 class RawSanity(Exception):
@@ -377,28 +605,24 @@ class Raw():
 		else:
 			if self.size % 320 == 0:
 				self.width = 320
-				self.height = self.size / 320
+				self.height = self.size // 320
 			else:
 				raise RawSanity('Dimensions of raw image could not be determined!')
 		self.data = data
 	
 	def to_rgba(self, palette):
-		# Zeros will init as transparent pixels
-		rgba = io.BytesIO(b'\0' * self.width * self.height * 4)
-		for entry in self.data:
-			r, g, b = palette[entry]
-			rgba.write(struct.pack('BBBB', r, g, b, 255))
-		rgba_bytes = rgba.getvalue()
-		rgba.close()
-		return rgba_bytes
+		import numpy as np
+		return palette.rgba()[np.frombuffer(self.data, dtype=np.uint8)].tobytes()
 	
 	def to_image(self, palette):
+		from PIL import Image
 		return Image.frombytes('RGBA', (self.width, self.height), self.to_rgba(palette))
 
 # Try to detect and handle any ZDoom graphic format
 # https://stackoverflow.com/questions/5165317/how-can-i-extend-image-class
 class ZImage():
 	def __init__(self, data, palette, convert=True):
+		from PIL import Image
 		self.leftoffset = self.topoffset = None
 		if isinstance(data, Image.Image):
 			self._img = data
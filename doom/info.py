@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 # Parse and manipulate iwadinfo lumps
-from collections import OrderedDict, Callable
+from collections import OrderedDict
+from collections.abc import Callable
 import re
 import io
+import fnmatch
 import struct
 
 class DefaultOrderedDict(OrderedDict):
@@ -40,7 +42,7 @@ class DefaultOrderedDict(OrderedDict):
 
 	def __deepcopy__(self, memo):
 		import copy
-		return type(self)(self.default_factory, copy.deepcopy(self.items()))
+		return type(self)(self.default_factory, copy.deepcopy(list(self.items()), memo))
 
 	def __repr__(self):
 		return 'OrderedDefaultDict(%s, %s)' % (self.default_factory, OrderedDict.__repr__(self))
@@ -59,6 +61,57 @@ def comment_remover(text):
 	)
 	return re.sub(pattern, replacer, text)
 
+# Tokenizer for the ZDoom text lump family (IWADINFO, MAPINFO, TEXTURES, SNDINFO, DECORATE...)
+# Whitespace and comments are skipped along with each token, newlines are kept as tokens since some of the formats are line based
+# https://zdoom.org/wiki/Using_ZIPs_as_WAD_replacement
+token_re = re.compile(r"""
+	(?:[ \t\r]+|//[^\n]*|/\*.*?\*/)*
+	(?:
+		(\n)
+		|("(?:\\.|[^\\"])*"?)
+		|([{}=,;])
+		|((?:[^\s{}=,;"/]|/(?![/*]))+)
+	)
+""", re.VERBOSE | re.DOTALL)
+
+# List of (kind, text) for each token, kind being 'newline', 'string', 'symbol' or 'word'
+def tokenize(text):
+	return [
+		('word', word) if word else ('string', string) if string else ('symbol', symbol) if symbol else ('newline', newline)
+		for newline, string, symbol, word in token_re.findall(text)
+	]
+
+# Token text with quotes removed, for strings
+def token_value(token):
+	kind, text = token
+	if kind == 'string':
+		return text[1:-1] if len(text) > 1 and text[-1] == '"' else text[1:]
+	return text
+
+# Group tokens into lines, skipping empty ones
+def token_lines(text):
+	line = []
+	for token in tokenize(text):
+		if token[0] == 'newline':
+			if line:
+				yield line
+				line = []
+		else:
+			line.append(token)
+	if line:
+		yield line
+
+# Numbers as numbers, anything else stays as is
+def word_value(text):
+	try:
+		return int(text)
+	except ValueError:
+		pass
+	try:
+		return float(text)
+	except ValueError:
+		return text
+
 class Gzinfo:
 	def __init__(self, lump):
 		if isinstance(lump, str):
@@ -105,76 +158,140 @@ class Gzinfo:
 						for entry in value:
 							if isinstance(entry, str):
 								string += '"' + entry + '", '
-							elif isinstance(entry, int):
+							elif isinstance(entry, (int, float)):
 								string += str(entry) + ', '
 						string = string[:-2] # Remove last ', '
 						string += '\n'
 				elif isinstance(value, str):
 					string += '\t' * tablevel + key + ' = "' + value + '"\n'
-				elif isinstance(value, int):
+				elif isinstance(value, (int, float)):
 					string += '\t' * tablevel + key + ' = ' + str(value) + '\n'
 		return string
 		
 	# Parse raw text from iwadinfo/mapinfo
+	# Single pass over the tokens, blocks are parsed recursively as they are encountered
 	def parse(self, text):
-		parsed = DefaultOrderedDict(lambda: [])
-		text = [line.strip() for line in comment_remover(text).splitlines() if line.strip()]
-		while text:
-			if len(text) > 1 and text[1] == '{':
-				subtext = ''
-				while text[2] != '}':
-					subtext += text.pop(2) + '\n'
-				text.pop(2)
-				text.pop(1)
-				
-				args = text[0].split(' ')
-				proptype = args.pop(0)
-				
-				subthing = self.parse(subtext)
-				if isinstance(subthing, dict):
-					if args:
-						subthing['args'] = args
-					parsed[proptype].append(subthing)
+		tokens = tokenize(text)
+		# Sentinel so lookahead never runs off the end
+		tokens.append(('end', ''))
+		
+		# Comma separated values after an '=', a trailing comma continues onto the next line
+		def parse_values(pos):
+			entries = []
+			words = []
+			while True:
+				kind, token_text = tokens[pos][0], tokens[pos][1]
+				if token_text == ',' or kind == 'newline' or kind == 'end' or token_text in '{};':
+					if len(words) == 1 and words[0][0] == 'string':
+						entries.append(token_value(words[0]))
+					elif words:
+						entries.append(word_value(' '.join(token_value(word) for word in words)))
+					words = []
+					if token_text != ',':
+						return pos, entries
+					pos += 1
+					# Skip to the next value, even on the next line
+					while tokens[pos][0] == 'newline':
+						pos += 1
 				else:
-					parsed[proptype] = subthing
-			elif '=' in text[0]:
-				name = text[0].split('=')[0].strip()
-				value = text[0].split('=')[1].strip()
-				while value[-1] == ',':
-					value += text.pop(1)
-				if ',' in value:
-					entries = []
-					for entry in value.split(','):
-						if '"' in entry:
-							entries.append(entry.strip().strip('"'))
-						else:
-							entries.append(int(entry.strip()))
-					parsed[name] = entries
+					words.append(tokens[pos])
+					pos += 1
+		
+		# Statements until the closing brace (or the end), returns a DefaultOrderedDict, or a list if it is a list of quoted values
+		def parse_block(pos):
+			parsed = DefaultOrderedDict(lambda: [])
+			while True:
+				kind, token_text = tokens[pos][0], tokens[pos][1]
+				if kind == 'end':
+					return pos, parsed
+				elif kind == 'newline' or token_text == ';':
+					pos += 1
+				elif token_text == '}':
+					return pos + 1, parsed
+				elif kind == 'string':
+					# List of quoted values encountered, use a list rather than a dict
+					if not isinstance(parsed, list):
+						parsed = []
+					while tokens[pos][0] != 'newline' and tokens[pos][0] != 'end' and tokens[pos][1] != '}':
+						if tokens[pos][0] == 'string':
+							parsed.append(token_value(tokens[pos]))
+						pos += 1
+				elif tokens[pos + 1][1] == '=':
+					# Most are just one value on its own line
+					value = tokens[pos + 2]
+					if tokens[pos + 3][0] == 'newline' and value[0] != 'symbol':
+						parsed[token_text] = token_value(value) if value[0] == 'string' else word_value(value[1])
+						pos += 4
+						continue
+					pos, entries = parse_values(pos + 2)
+					if len(entries) > 1:
+						parsed[token_text] = entries
+					elif entries:
+						parsed[token_text] = entries[0]
+				elif token_text == '{':
+					# Block without a header, nothing to file it under
+					pos, _ = parse_block(pos + 1)
 				else:
-					if '"' in value:
-						parsed[name] = value.strip('"')
+					# Block header is everything up to the end of the line, the block itself may start on the next
+					args = []
+					while tokens[pos][0] != 'newline' and tokens[pos][0] != 'end' and tokens[pos][1] not in '{}':
+						args.append(tokens[pos][1])
+						pos += 1
+					while tokens[pos][0] == 'newline':
+						pos += 1
+					if tokens[pos][1] != '{':
+						# Not a block or assignment (a flag or the like), nothing to keep
+						continue
+					
+					proptype = args.pop(0)
+					
+					pos, subthing = parse_block(pos + 1)
+					if isinstance(subthing, dict):
+						if args:
+							subthing['args'] = args
+						parsed[proptype].append(subthing)
 					else:
-						parsed[name] = int(value)
-			elif text[0][0] == '"':
-				# List of quoted values encountered, use a list rather than a dict
-				if not isinstance(parsed, list):
-					parsed = []
-				parsed.append(text[0].strip('"'))
-			text.pop(0)
-		return parsed
+						parsed[proptype] = subthing
+		
+		return parse_block(0)[1]
 
 class Iwadinfo(Gzinfo):
-	def identify(self, wadname, has_lump):
-		for iwad in self.parsed['IWad']:
-			if 'MustContain' in iwad:
-				if isinstance(iwad['MustContain'], list):
-					if not all(has_lump(name) for name in iwad['MustContain']):
-						continue
-				else:
-					if not has_lump(iwad['MustContain']):
-						continue
-			return Iwadinfo({'IWad' : [iwad]})
-		return None
+	def __init__(self, lump):
+		super().__init__(lump)
+		self._table = None
+		self.identified = {}
+
+	# First IWad block whose MustContain are all in lump_names (a set of lowercase names, see Archive.lump_names)
+	# Results are kept by digest when given one, see Archive.digest
+	def identify(self, wadname, lump_names, digest=None):
+		if digest is not None and digest in self.identified:
+			return self.identified[digest]
+		for must_contain, patterns, iwad in self.table:
+			if not must_contain <= lump_names:
+				continue
+			if not all(fnmatch.filter(lump_names, pattern) for pattern in patterns):
+				continue
+			iwad_id = Iwadinfo({'IWad' : [iwad]})
+			break
+		else:
+			iwad_id = None
+		if digest is not None:
+			self.identified[digest] = iwad_id
+		return iwad_id
+
+	# Decision table for identify, (names, wildcard patterns, block) for every IWad block in order
+	@property
+	def table(self):
+		if self._table is None:
+			self._table = []
+			for iwad in self.parsed['IWad']:
+				must_contain = iwad.get('MustContain', [])
+				if not isinstance(must_contain, list):
+					must_contain = [must_contain]
+				must_contain = [name.lower() for name in must_contain]
+				patterns = [name for name in must_contain if any(c in name for c in '*?[')]
+				self._table.append((frozenset(name for name in must_contain if name not in patterns), patterns, iwad))
+		return self._table
 
 	# Cut out a couple steps for a single IWad def like an identity
 	def __getitem__(self, key):
@@ -198,15 +315,13 @@ class Sndinfo(Gzinfo):
 	# Parse raw text from sndinfo: https://zdoom.org/wiki/SNDINFO
 	def parse(self, text):
 		parsed = DefaultOrderedDict(lambda: [])
-		text = [line.strip() for line in comment_remover(text).splitlines() if line.strip()]
-		while text:
-			line = text[0].split()
+		for line in token_lines(text):
+			line = [token[1] for token in line]
 			# TODO: Parse all commands. Only parsing for commands referencing lump names for now
-			if line[0] == '$playersound':
+			if line[0] == '$playersound' and len(line) > 4:
 				parsed[line[3]] = line[4]
-			elif line[0][0] != '$':
+			elif line[0][0] != '$' and len(line) > 1:
 				parsed[line[0]] = line[1]
-			text.pop(0)
 		return parsed
 	
 	def getsndlumps(self):
@@ -214,12 +329,12 @@ class Sndinfo(Gzinfo):
 
 class PNames():
 	def __init__(self, data):
-		with io.BytesIO(data) as data_io:
-			data_io.seek(0)
-			self.num_entries = struct.unpack('I', data_io.read(4))[0]
-			self.entries = []
-			for i in range(self.num_entries):
-				self.entries.append(struct.unpack('8s', data_io.read(8))[0].decode('ASCII').rstrip('\0'))
+		self.num_entries = struct.unpack_from('I', data)[0]
+		self.entries = [name.decode('ASCII').rstrip('\0') for name, in struct.iter_unpack('8s', data[4:4 + self.num_entries * 8])]
+		# First index of each name, for lookups and 'in'
+		self.index = {}
+		for i, name in enumerate(self.entries):
+			self.index.setdefault(name, i)
 	
 	def __iter__(self):
 		for entry in self.entries:
@@ -227,8 +342,22 @@ class PNames():
 	
 	def __getitem__(self, key):
 		return self.entries[key]
+	
+	def __contains__(self, name):
+		return name in self.index
+	
+	def __len__(self):
+		return len(self.entries)
 		
 
+# Option values as written in TEXTURES, strings are quoted and multiple values are comma separated
+def texture_option(value):
+	if isinstance(value, tuple):
+		return ', '.join(texture_option(entry) for entry in value)
+	elif isinstance(value, str):
+		return '"' + value + '"'
+	return str(value)
+
 # https://zdoom.org/wiki/TEXTURES
 # ZDoom TEXTURES format texture info
 class TextureInfo(dict):
@@ -255,7 +384,7 @@ class TextureInfo(dict):
 				if isinstance(self[key], bool):
 					s += '\t' + key + '\n'
 				else:
-					s += '\t' + key + ' ' + str(self[key]).strip('()') + '\n'
+					s += '\t' + key + ' ' + texture_option(self[key]) + '\n'
 		
 		for patch in self['patches']:
 			for line in str(patch).split('\n'):
@@ -267,32 +396,23 @@ class TextureInfo(dict):
 	def __lt__(self, other):
 		return (self['namespace'].lower(), self['name'].lower()) < (other['namespace'].lower(), other['name'].lower())
 
-#	def from_string(text):
-#		text = [line.strip().strip('"').lower() for line in comment_remover(text).splitlines() if line.strip()]
-#		
-#		first = text.pop(0)
-#		tokens = first.split(',')
-#		if len(tokens) != 3:
-#			raise Exception('Unexpected Texture format!')
-#		firstoken = tokens[0].split()
-#		namespace = firstoken[0].strip().capitalize()
-#		if firstoken[1] == 'optional':
-#			optional = True
-#			name = firstoken[2].strip().upper()
-#		else:
-#			optional = False
-#			name = firstoken[1].strip().upper()
-#
-#		patches = []
-#		while text:
-#			if text[0].split()[0] in ['patch', 'graphic', 'sprite']:
-#				patch = text.pop(0)
-#				if '{' in text[0]:
-#					while '}' not in text[0]:
-#						patch += text.pop(0)
-#					patch += text.pop(0)
-#				patches.append(PatchInfo.from_string(patch))
-#			elif text[0].split()[0] in ['xscale', ]
+	# For cache_data, patch data is hashed instead of going through repr() with everything else
+	@property
+	def digest(self):
+		import hashlib
+		m = hashlib.md5(repr((self['width'], self['height'])).encode())
+		for patch in self['patches']:
+			m.update(repr([(key, value) for key, value in patch.items() if key != 'data']).encode())
+			if patch.get('data') is not None:
+				m.update(hashlib.md5(patch['data']).digest())
+		return m.digest()
+
+	# First definition in a bit of TEXTURES text
+	@staticmethod
+	def from_string(text):
+		for texture in Textures(text):
+			return texture
+		return None
 
 
 # ZDoom TEXTURES format patch info
@@ -320,126 +440,267 @@ class PatchInfo(dict):
 				if not started_options:
 					started_options = True
 					s += '\n{\n'
-				s += '\t' + key + ' ' + str(self[key]).strip('()') + '\n'
+				if isinstance(self[key], bool):
+					s += '\t' + key + '\n'
+				else:
+					s += '\t' + key + ' ' + texture_option(self[key]) + '\n'
 		if started_options:
 			s += '}'
 		s += '\n'
 		return s
 
+# TEXTURES keywords are case insensitive, these map them back to how they are spelled here
+texture_namespaces = {ns.lower(): ns for ns in ['Texture', 'WallTexture', 'Flat', 'Sprite', 'Graphic']}
+patch_namespaces = {ns.lower(): ns for ns in ['Patch', 'Graphic', 'Sprite']}
+texture_options = {key.lower(): key for key in ['XScale', 'YScale', 'Offset', 'Offset2', 'WorldPanning', 'NoDecals', 'NullTexture']}
+patch_options = {key.lower(): key for key in ['FlipX', 'FlipY', 'UseOffsets', 'Rotate', 'Translation', 'Colormap', 'Blend', 'Alpha', 'Style']}
+# Options that don't take a value
+texture_flags = {'worldpanning', 'nodecals', 'nulltexture', 'notrim', 'flipx', 'flipy', 'useoffsets'}
+
+# ZDoom TEXTURES lump, definitions are parsed as they are iterated over
+# include is called with the name of any #include'd lump and should return its text (or None if it can't be found)
+# Anything that isn't a texture definition (e.g. old style 'define') is skipped
+class Textures():
+	def __init__(self, text, include=None, included=None):
+		if isinstance(text, bytes):
+			text = text.decode('utf-8', errors='replace')
+		self.text = text
+		self.include = include
+		# Shared with any included lumps, so an include loop doesn't go on forever
+		self.included = included if included is not None else set()
+	
+	def __iter__(self):
+		tokens = [token for token in tokenize(self.text) if token[0] != 'newline']
+		# Sentinel so lookahead never runs off the end
+		tokens.append(('end', ''))
+		
+		# Comma separated values, a word that isn't a number is only taken as the first value if required
+		def parse_values(pos, required):
+			entries = []
+			while True:
+				kind, token_text = tokens[pos]
+				if kind == 'string':
+					entries.append(token_value(tokens[pos]))
+				elif kind == 'word':
+					value = word_value(token_text)
+					if isinstance(value, str) and not required:
+						break
+					entries.append(value)
+				else:
+					break
+				pos += 1
+				if tokens[pos][1] != ',':
+					break
+				pos += 1
+				required = True
+			return pos, entries
+		
+		# Skip over a block (and any blocks in it) starting at its '{'
+		def skip_block(pos):
+			depth = 0
+			while tokens[pos][0] != 'end':
+				if tokens[pos][1] == '{':
+					depth += 1
+				elif tokens[pos][1] == '}':
+					depth -= 1
+					if depth == 0:
+						return pos + 1
+				pos += 1
+			return pos
+		
+		# Options of a texture or patch, up to and including the closing brace
+		def parse_options(pos, info, options, nested=None):
+			while tokens[pos][1] != '}' and tokens[pos][0] != 'end':
+				key = tokens[pos][1].lower()
+				if nested and key in patch_namespaces:
+					pos = nested(pos, info)
+				elif tokens[pos][1] == '{':
+					pos = skip_block(pos)
+				elif key in texture_flags:
+					if key in options:
+						info[options[key]] = True
+					pos += 1
+				else:
+					pos, entries = parse_values(pos + 1, key in options)
+					if key in options and entries:
+						info[options[key]] = entries[0] if len(entries) == 1 else tuple(entries)
+			return pos + 1 if tokens[pos][0] != 'end' else pos
+		
+		# Namespace "name", a, b [{ options }], returns None for the info if it isn't valid
+		def parse_definition(pos, namespaces, options, make, nested=None):
+			namespace = namespaces[tokens[pos][1].lower()]
+			pos += 1
+			optional = tokens[pos][0] == 'word' and tokens[pos][1].lower() == 'optional'
+			if optional:
+				pos += 1
+			pos, header = parse_values(pos, True)
+			if len(header) != 3 or not all(isinstance(value, (int, float)) for value in header[1:]):
+				if tokens[pos][1] == '{':
+					pos = skip_block(pos)
+				return pos, None
+			info = make(str(header[0]), int(header[1]), int(header[2]), namespace, optional)
+			if tokens[pos][1] == '{':
+				pos = parse_options(pos + 1, info, options, nested)
+			return pos, info
+		
+		def make_texture(name, width, height, namespace, optional):
+			return TextureInfo(name.upper(), width, height, [], optional=optional, namespace=namespace)
+		
+		def make_patch(name, xorigin, yorigin, namespace, optional):
+			return PatchInfo(name, xorigin, yorigin, namespace=namespace)
+		
+		def parse_patch(pos, texture):
+			pos, patch = parse_definition(pos, patch_namespaces, patch_options, make_patch)
+			if patch:
+				texture['patches'].append(patch)
+			return pos
+		
+		pos = 0
+		while tokens[pos][0] != 'end':
+			keyword = tokens[pos][1].lower()
+			if keyword == '#include':
+				pos += 1
+				name = token_value(tokens[pos])
+				if self.include and name.lower() not in self.included:
+					self.included.add(name.lower())
+					text = self.include(name)
+					if text:
+						yield from Textures(text, self.include, self.included)
+				pos += 1
+			elif tokens[pos][0] == 'word' and keyword in texture_namespaces:
+				pos, texture = parse_definition(pos, texture_namespaces, texture_options, make_texture, parse_patch)
+				if texture:
+					yield texture
+			elif tokens[pos][1] == '{':
+				pos = skip_block(pos)
+			else:
+				pos += 1
+
 class TextureXSanity(Exception):
 	pass
 
 # TODO: Support 'NullTexture'
+# Textures are kept as columns in NumPy arrays, TextureInfo is only built for the textures actually looked at
 class TextureX():
 	def __init__(self, texture_lumps, pnames, hacks=False):
+		import numpy as np
+		
 		self.pnames = pnames
-		self.textures = []
+		self.names = []
+		# First index of each name, earlier lumps win like they used to with a linear search
+		self.index = {}
+		textures = []
+		patches = []
+		patch_total = 0
+		
+		# https://doomwiki.org/wiki/TEXTURE1_and_TEXTURE2
+		# Zdoom extended format - uses 'masked' 4 byte value to represent flags, scalex, and scaley. Width is signed according to the wiki for some reason.
+		header_fields = [('name', 'S8'), ('flags', '<u2'), ('scalex', 'u1'), ('scaley', 'u1'), ('width', '<i2'), ('height', '<i2')]
+		doom_header = np.dtype(header_fields + [('columndirectory', '<u4'), ('patchcount', '<i2')])
+		strife_header = np.dtype(header_fields + [('patchcount', '<i2')])
+		# Doom patches also have unused stepdir and colormap after these, they are skipped over
+		patch_dtype = np.dtype([('originx', '<i2'), ('originy', '<i2'), ('patch', '<i2')])
+		# What gets kept per texture, patches for a texture are patchcount entries in self.patches starting at patch_start
+		texture_dtype = np.dtype([('flags', '<u2'), ('scalex', 'u1'), ('scaley', 'u1'), ('width', '<i2'), ('height', '<i2'), ('patch_start', '<i8'), ('patchcount', '<i2')])
 		
 		for texture_lump in texture_lumps:
 			if not texture_lump:
 				continue
-			data_io = io.BytesIO(texture_lump)
 
-			if hacks:
-				import hashlib
-				lump_hash = hashlib.md5(texture_lump).hexdigest()
-
-			numtextures = struct.unpack('i', data_io.read(4))[0]
-			texture_offsets = []
-			for i in range(numtextures):
-				texture_offsets.append(struct.unpack('i', data_io.read(4))[0])
+			numtextures = struct.unpack_from('i', texture_lump)[0]
+			if numtextures <= 0:
+				continue
+			texture_offsets = np.frombuffer(texture_lump, dtype='<i4', count=numtextures, offset=4).astype(np.int64)
 			
 			# First test for strife format (skips unused columndirectory, stepdir and colormap)
 			# GZDoom does a different test here which I don't think is a great test.
 			# Instead make sure the total size makes sense for either format.
-			data_io.seek(texture_offsets[-1] + 0x10)
-			strife_patchcount = struct.unpack('h', data_io.read(2))[0]
-			data_io.seek(texture_offsets[-1] + 0x14)
-			doom_patchcount = struct.unpack('h', data_io.read(2))[0]
-			strife_format = False
+			strife_patchcount = struct.unpack_from('h', texture_lump, texture_offsets[-1] + 0x10)[0]
+			doom_patchcount = struct.unpack_from('h', texture_lump, texture_offsets[-1] + 0x14)[0]
 			if (texture_offsets[-1] + 0x12 + strife_patchcount * 6) == len(texture_lump):
-				strife_format = True
-			elif (texture_offsets[-1] + 0x16 + doom_patchcount * 10) != len(texture_lump):
+				header_dtype = strife_header
+				patch_size = 6
+			elif (texture_offsets[-1] + 0x16 + doom_patchcount * 10) == len(texture_lump):
+				header_dtype = doom_header
+				patch_size = 10
+			else:
 				raise TextureXSanity('Total size does not make sense for either Doom or Strife format!')
 			
-			for texture_offset in texture_offsets:
-				data_io.seek(texture_offset)
-				
-				texture = {
-					'name'   : struct.unpack('8s', data_io.read(8))[0].decode('ASCII').rstrip('\0'),
-					# Zdoom extended format - uses 'masked' 4 byte value to represent flags, scalex, and scaley
-					'flags'  : bool(struct.unpack('H', data_io.read(2))[0]),
-					'scalex' : struct.unpack('B', data_io.read(1))[0],
-					'scaley' : struct.unpack('B', data_io.read(1))[0],
-					'width'  : struct.unpack('h', data_io.read(2))[0], # Wiki says this is signed for some reason?
-					'height' : struct.unpack('h', data_io.read(2))[0],
-				}
-
-				if not strife_format:
-					# unused, but parse it anyway
-					texture['columndirectory'] = []
-					for i in range(4):
-						texture['columndirectory'].append(struct.unpack('B', data_io.read(1))[0])
-				
-				patchcount = struct.unpack('h', data_io.read(2))[0]
-				patches = []
-				for i in range(patchcount):
-					patch = {
-						'originx' : struct.unpack('h', data_io.read(2))[0],
-						'originy' : struct.unpack('h', data_io.read(2))[0],
-						'patch'   : struct.unpack('h', data_io.read(2))[0],
-					}
-					
-					if not strife_format:
-						# unused, but parse it anyway
-						patch['stepdir']  = struct.unpack('h', data_io.read(2))[0]
-						patch['colormap'] = struct.unpack('h', data_io.read(2))[0]
-					patches.append(patch)
-				texture['patches'] = patches
+			# Gather every texture header, then every patch, out of the lump in one go
+			lump_bytes = np.frombuffer(texture_lump, dtype=np.uint8)
+			headers = lump_bytes[texture_offsets[:, None] + np.arange(header_dtype.itemsize)].view(header_dtype).reshape(-1)
+			patchcounts = headers['patchcount'].astype(np.int64)
+			patch_starts = np.cumsum(patchcounts) - patchcounts
+			patch_offsets = np.repeat(texture_offsets + header_dtype.itemsize - patch_starts * patch_size, patchcounts) + np.arange(patchcounts.sum()) * patch_size
+			lump_patches = lump_bytes[patch_offsets[:, None] + np.arange(patch_dtype.itemsize)].view(patch_dtype).reshape(-1)
+			
+			lump_names = [name.decode('ASCII').rstrip('\0') for name in headers['name'].tolist()]
+			lump_index = {}
+			for i, name in enumerate(lump_names):
+				lump_index.setdefault(name, i)
+			
+			# Equivalent of FMultipatchTextureBuilder::CheckForHacks()
+			if hacks:
+				import hashlib
+				lump_hash = hashlib.md5(texture_lump).hexdigest()
 				
-				# Equivalent of FMultipatchTextureBuilder::CheckForHacks()
-				if hacks:
-					if lump_hash == '9f4957d0d57ff1eeb3f398ce78b29af9': # TEXTURE1 doom.wad
-						if texture['name'] == 'SKY1':
-							texture['patches'][0]['originy'] = 0 # Originally -8
-					if lump_hash in ['504034fe4f64d013d116ceb6c30f4d57','3cb230c3e9adaeea06f5e8160d06e17b']: # TEXTURE2 doom, doomu
-						if texture['name'] == 'BIGDOOR7':
-							# In Doom Registered / Ultimate BIGDOOR7 is (-4,-4),(124,-4). This results in a render problem in ZDoom, but by luck/glitch it renders right in Vanilla Doom
-							texture['patches'][0]['originy'] = 0 # Originally -4
-							texture['patches'][1]['originy'] = 0 # Originally -4
-					if lump_hash in ['5698887560a77c74446f9c4a112dc48b', '96f1a941ac536ff2c224b3383902fcb6', '0f03e07e0a2d52703dbf6717633fa64d']: # TEXTURE1 doom2, tnt, plutonia
-						if texture['name'] == 'BIGDOOR7':
-							# Doom 2 doesn't have the originy problem Doom 1 does. But it does change to (-5, 0),(123, 0).
-							# That makes the texture annoyingly slightly different than Doom 1, and a little off center for no good known reason.
-							# The texture can't be perfectly center though. Apparently demons can't hang skulls on center, nor their doors perfectly well. No rulers in hell.
-							texture['patches'][0]['originx'] = -4 # Originally -5
-							texture['patches'][1]['originx'] = 124 # Originally 123
+				# Every texture by that name, not just the first, the later ones are what win
+				def set_patch(name, patch, field, value):
+					for i, lump_name in enumerate(lump_names):
+						if lump_name == name:
+							lump_patches[field][patch_starts[i] + patch] = value
 				
-				self.textures.append(texture)
-			data_io.close()
+				if lump_hash == '9f4957d0d57ff1eeb3f398ce78b29af9': # TEXTURE1 doom.wad
+					set_patch('SKY1', 0, 'originy', 0) # Originally -8
+				if lump_hash in ['504034fe4f64d013d116ceb6c30f4d57','3cb230c3e9adaeea06f5e8160d06e17b']: # TEXTURE2 doom, doomu
+					# In Doom Registered / Ultimate BIGDOOR7 is (-4,-4),(124,-4). This results in a render problem in ZDoom, but by luck/glitch it renders right in Vanilla Doom
+					set_patch('BIGDOOR7', 0, 'originy', 0) # Originally -4
+					set_patch('BIGDOOR7', 1, 'originy', 0) # Originally -4
+				if lump_hash in ['5698887560a77c74446f9c4a112dc48b', '96f1a941ac536ff2c224b3383902fcb6', '0f03e07e0a2d52703dbf6717633fa64d']: # TEXTURE1 doom2, tnt, plutonia
+					# Doom 2 doesn't have the originy problem Doom 1 does. But it does change to (-5, 0),(123, 0).
+					# That makes the texture annoyingly slightly different than Doom 1, and a little off center for no good known reason.
+					# The texture can't be perfectly center though. Apparently demons can't hang skulls on center, nor their doors perfectly well. No rulers in hell.
+					set_patch('BIGDOOR7', 0, 'originx', -4) # Originally -5
+					set_patch('BIGDOOR7', 1, 'originx', 124) # Originally 123
+			
+			for name, i in lump_index.items():
+				self.index.setdefault(name, len(self.names) + i)
+			self.names += lump_names
+			
+			texture_columns = np.empty(len(headers), dtype=texture_dtype)
+			for field in ['flags', 'scalex', 'scaley', 'width', 'height', 'patchcount']:
+				texture_columns[field] = headers[field]
+			texture_columns['patch_start'] = patch_starts + patch_total
+			patch_total += len(lump_patches)
+			textures.append(texture_columns)
+			patches.append(lump_patches)
+		
+		self.textures = np.concatenate(textures) if textures else np.empty(0, dtype=texture_dtype)
+		self.patches = np.concatenate(patches) if patches else np.empty(0, dtype=patch_dtype)
 	
 	# convert to populated full ZDoom format
-	def to_TextureInfo(self, texture):
+	def to_TextureInfo(self, index):
+		flags, scalex, scaley, width, height, patch_start, patchcount = self.textures[index].tolist()
 		patches = []
-		for patch in texture['patches']:
-			patch_name = self.pnames[patch['patch']]
-			patches.append(PatchInfo(patch_name, patch['originx'], patch['originy']))
-		return TextureInfo(texture['name'], texture['width'], texture['height'], patches,
-			XScale = texture['scalex'] / 8 if texture['scalex'] else 1.0,
-			YScale = texture['scaley'] / 8 if texture['scaley'] else 1.0,
-			WorldPanning = bool(texture['flags'] & 0x8000),
+		for originx, originy, patch in self.patches[patch_start:patch_start + patchcount].tolist():
+			patches.append(PatchInfo(self.pnames[patch], originx, originy))
+		return TextureInfo(self.names[index], width, height, patches,
+			XScale = scalex / 8 if scalex else 1.0,
+			YScale = scaley / 8 if scaley else 1.0,
+			WorldPanning = bool(flags & 0x8000),
 			namespace = 'WallTexture')
 
+	def __len__(self):
+		return len(self.names)
+
 	def __iter__(self):
-		for texture in self.textures:
-			yield self.to_TextureInfo(texture)
+		for index in range(len(self.names)):
+			yield self.to_TextureInfo(index)
 
 	def __getitem__(self, key):
 		if isinstance(key, str):
-			for texture in self.textures:
-				if texture['name'] == key:
-					return self.to_TextureInfo(texture)
-		return self.to_TextureInfo(self.textures[key])
+			return self.to_TextureInfo(self.index[key])
+		return self.to_TextureInfo(key)
 	
 	def __str__(self):
 		s = ''
@@ -447,18 +708,51 @@ class TextureX():
 			s += str(texture) + '\n'
 		return s
 
+# PLAYPAL as a (palettes, 256, 4) RGBA array, with COLORMAP light levels as a (levels, 256) index array if given
+# https://doomwiki.org/wiki/PLAYPAL
+# https://doomwiki.org/wiki/COLORMAP
 class Palette():
-	def __init__(self, data):
+	def __init__(self, data, colormap=None):
+		import numpy as np
+		import hashlib
+		
 		num_palettes = int(len(data) / (256 * 3))
-		data_io = io.BytesIO(data)
-		self.palettes = []
-		for palette_index in range(num_palettes):
-			palette = []
-			for color_index in range(256):
-				palette.append(struct.unpack('BBB', data_io.read(3)))
-			self.palettes.append(palette)
-		data_io.close()
+		rgb = np.frombuffer(data, dtype=np.uint8, count=num_palettes * 256 * 3).reshape(num_palettes, 256, 3)
+		self.palettes = np.full((num_palettes, 256, 4), 255, dtype=np.uint8)
+		self.palettes[:, :, :3] = rgb
+		self.colormaps = None
+		if colormap:
+			num_levels = int(len(colormap) / 256)
+			self.colormaps = np.frombuffer(colormap, dtype=np.uint8, count=num_levels * 256).reshape(num_levels, 256)
+		# Plain tuples of the 'normal' palette for per pixel lookups
+		self.colors = [tuple(color) for color in rgb[0].tolist()]
+		
+		# For the cache layer, see cache_data
+		m = hashlib.md5(self.palettes)
+		if self.colormaps is not None:
+			m.update(self.colormaps)
+		self.digest = m.digest()
+
+	def __len__(self):
+		return len(self.palettes)
 
 	# Default to 'normal' palette
 	def __getitem__(self, key):
-		return self.palettes[0][key]
+		return self.colors[key]
+
+	# RGBA lookup table for index arrays, e.g. palette.rgba()[indices]
+	# Optionally another palette (pain, pickup, radiation suit) and/or a light level from COLORMAP
+	def rgba(self, palette=0, light=None):
+		if light is None:
+			return self.palettes[palette]
+		return self.palettes[palette][self.colormaps[light]]
+
+	# Same thing as a Palette, so damage/pickup/light level versions of graphics can go through the usual rendering functions
+	def variant(self, palette=0, light=None):
+		import hashlib
+		variant = Palette.__new__(Palette)
+		variant.palettes = self.rgba(palette, light)[None]
+		variant.colormaps = None
+		variant.colors = [tuple(color[:3]) for color in variant.palettes[0].tolist()]
+		variant.digest = hashlib.md5(variant.palettes).digest()
+		return variant
@@ -1,15 +1,161 @@
 import io
 import struct
+from doom.util import cache_data
+
+# TODO: Support any format GZDoom can support for music (MIDI already plays as is)
+
+def lump_to_music(data, fmt='mid'):
+	try:
+		if fmt == 'mid':
+			return mus_to_midi(data)
+		else:
+			raise Exception('Unsupported format!')
+	except:
+		pass
+
+@cache_data
+def mus_to_midi(data):
+	return Mus(data).to_midi()
+
+# Event types, the upper nibble of the event byte (minus the 'last' flag)
+# https://doomwiki.org/wiki/MUS
+mus_release   = 0
+mus_press     = 1
+mus_pitch     = 2
+mus_system    = 3
+mus_control   = 4
+mus_measure   = 5
+mus_end       = 6
+
+# MUS controller number to MIDI controller number, 0 is a program change and handled separately
+# https://github.com/chocolate-doom/chocolate-doom/blob/master/src/mus2mid.c
+controller_map = [
+	0x00, 0x20, 0x01, 0x07, 0x0A, 0x0B, 0x5B, 0x5D,
+	0x40, 0x43, 0x78, 0x7B, 0x7E, 0x7F, 0x79
+]
 
-# TODO: Support midi, as well as any format GZDoom can support for music
 class Mus():
 	def __init__(self, data):
-		with io.BytesIO(data) as data_file:
-			data_file.seek(0,2)
-			total_size = data_file.tell()
-			data_file.seek(0)
-
-			self.sig = struct.unpack('<4s', data_file.read(4))[0]
-			if self.sig != b'MUS\x1A':
-				raise Exception("Sanity check failure for MUS music!")
-			# TODO: Actually support MUS :)
+		if len(data) < 16:
+			raise Exception("Sanity check failure for MUS music!")
+		self.sig, self.score_len, self.score_start, self.channels, self.sec_channels, self.num_instruments, self.dummy = struct.unpack_from('<4sHHHHHH', data)
+		if self.sig != b'MUS\x1A':
+			raise Exception("Sanity check failure for MUS music!")
+		if self.score_start > len(data) or 16 + self.num_instruments * 2 > len(data):
+			raise Exception("Sanity check failure for MUS music!")
+		self.instruments = list(struct.unpack_from('<' + 'H' * self.num_instruments, data, 16))
+		self.data = data
+
+	# Yield (event, channel, value1, value2, delay) for every event in the score, delay is the number of ticks to wait after it
+	# Values are as they appear in the lump, value2 is only used by controller changes and notes with a volume
+	def events(self):
+		data = self.data
+		pos = self.score_start
+		end = len(data)
+		while pos < end:
+			descriptor = data[pos]
+			pos += 1
+			event = (descriptor >> 4) & 0x7
+			channel = descriptor & 0xF
+			value1 = value2 = None
+			if event in [mus_release, mus_pitch, mus_system]:
+				value1 = data[pos]
+				pos += 1
+			elif event == mus_press:
+				value1 = data[pos]
+				pos += 1
+				# Volume follows if the high bit of the note is set
+				if value1 & 0x80:
+					value2 = data[pos]
+					pos += 1
+			elif event == mus_control:
+				value1, value2 = data[pos], data[pos + 1]
+				pos += 2
+			elif event == mus_end:
+				yield event, channel, value1, value2, 0
+				return
+			elif event != mus_measure:
+				raise Exception('Unknown MUS event ' + str(event) + '!')
+
+			delay = 0
+			if descriptor & 0x80:
+				# Variable length, 7 bits at a time
+				while True:
+					byte = data[pos]
+					pos += 1
+					delay = (delay << 7) | (byte & 0x7F)
+					if not byte & 0x80:
+						break
+			yield event, channel, value1, value2, delay
+
+	# Convert to a type 0 MIDI file, same as Chocolate Doom's mus2mid
+	# Events are written to the track as they come out of events()
+	def to_midi(self):
+		with io.BytesIO() as midi:
+			# 70 ticks per quarter note at the default 120 bpm is 140 ticks a second, same as MUS
+			midi.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, 70))
+			midi.write(b'MTrk\0\0\0\0')
+			track_start = midi.tell()
+
+			channel_map = [-1] * 16
+			velocities = [127] * 16
+			queued = 0
+
+			def write(*event):
+				nonlocal queued
+				# Delta time as a variable length quantity
+				delta = bytearray([queued & 0x7F])
+				queued >>= 7
+				while queued:
+					delta.insert(0, 0x80 | (queued & 0x7F))
+					queued >>= 7
+				midi.write(delta + bytes(event))
+
+			def midi_channel(channel):
+				# Percussion is always 15 in MUS and 9 in MIDI
+				if channel == 15:
+					return 9
+				if channel_map[channel] == -1:
+					allocated = max(channel_map) + 1
+					if allocated == 9:
+						allocated = 10
+					channel_map[channel] = allocated
+					# First time using the channel, send an 'all notes off'
+					# https://www.doomworld.com/vb/source-ports/66802-the
+					write(0xB0 | allocated, 0x7B, 0)
+				return channel_map[channel]
+
+			for event, channel, value1, value2, delay in self.events():
+				if event == mus_end:
+					break
+				if event != mus_measure:
+					channel = midi_channel(channel)
+				if event == mus_release:
+					write(0x80 | channel, value1 & 0x7F, 0)
+				elif event == mus_press:
+					if value2 is not None:
+						velocities[channel] = value2 & 0x7F
+					write(0x90 | channel, value1 & 0x7F, velocities[channel])
+				elif event == mus_pitch:
+					bend = value1 * 64
+					write(0xE0 | channel, bend & 0x7F, (bend >> 7) & 0x7F)
+				elif event == mus_system:
+					if value1 < 10 or value1 > 14:
+						raise Exception('Invalid MUS system event ' + str(value1) + '!')
+					write(0xB0 | channel, controller_map[value1], 0)
+				elif event == mus_control:
+					if value1 == 0:
+						write(0xC0 | channel, value2 & 0x7F)
+					else:
+						if value1 > 9:
+							raise Exception('Invalid MUS controller ' + str(value1) + '!')
+						# Vanilla quirk, values should be 7 bit but can come in as 8
+						write(0xB0 | channel, controller_map[value1], value2 if not value2 & 0x80 else 0x7F)
+				queued += delay
+			# End of track
+			write(0xFF, 0x2F, 0)
+
+			track_len = midi.tell() - track_start
+			midi.seek(track_start - 4)
+			midi.write(struct.pack('>I', track_len))
+			return midi.getvalue()
@@ -1,7 +1,6 @@
 import io
 import struct
 from doom.util import cache_data
-import soundfile as sf
 
 # https://github.com/chocolate-doom/chocolate-doom/blob/5329fb5d75971138b20abf940ed63635bd2861e0/src/i_pcsound.c#L44
 timer_freq = 1193181
@@ -86,71 +85,110 @@ class Dmx():
 		if self.format == 3:
 			return self.raw, self.samplerate, self.samples
 		elif self.format == 0:
-			with io.BytesIO(self.raw) as data_file:
-				data_file.seek(0)
-				# Generate a square wave PCM_U8 for emulating PC speaker sound
-				with io.BytesIO() as pc_pcm:
-					# Arbitrary high/standard sampling frequency
-					samplerate = 44100
-					volume = 20
-					pc_rate = timer_freq * 2
-					pc_state = 128 - volume
-					pc_count = 0
-					tick_count = 0
-					note = 0
-					note_ticks = int(pc_rate / 140)
-					sample_ticks = int(pc_rate / samplerate)
-					sample_count = 0
-					# self.samples are 'notes' in this context. each note lasts 1/140th of a second
-					total_ticks = int(pc_rate * (1/140 * self.samples))
-					# Looping through all the ticks of the pc speaker timer chip as I understand it, then 'sampling' from its output
-					# This is hilariously inefficient, but very accurate afaik. I could be wrong though. I often am. Also I am sure there is a better way to do it.
-					ticks = 0
-					while ticks < total_ticks:
-						# Skip ahead to next event, makes this loop a lot faster
-						next_note = note_ticks - (ticks % note_ticks) if (ticks % note_ticks) else 0
-						next_sample = sample_ticks - (ticks % sample_ticks) if (ticks % sample_ticks) else 0
-						if pc_count > 0:
-							ticks += min(next_note, next_sample, pc_count)
-							tick_count += min(next_note, next_sample, pc_count)
-						else:
-							ticks += min(next_note, next_sample)
-						
-						if ticks % note_ticks == 0:
-							try:
-								pc_count = counters[self.raw[note]]
-								note += 1
-							except:
-								pass
+			import numpy as np
+			# Generate a square wave PCM_U8 for emulating PC speaker sound
+			# Arbitrary high/standard sampling frequency
+			samplerate = 44100
+			volume = 20
+			pc_rate = timer_freq * 2
+			note_ticks = int(pc_rate / 140)
+			sample_ticks = int(pc_rate / samplerate)
+			# self.samples are 'notes' in this context. each note lasts 1/140th of a second
+			total_ticks = int(pc_rate * (1/140 * self.samples))
+			if total_ticks <= 0:
+				return b'', samplerate, 0
 
-						if pc_count == 0:
-							pc_state = 128
-							tick_count = 0
-						elif tick_count >= pc_count:
-							tick_count = 0
-							if pc_state > 127:
-								pc_state = 128 - volume
-							else:
-								pc_state = 128 + volume
-						else:
-							tick_count += 1
-						
-						if ticks % sample_ticks == 0:
-							pc_pcm.write(struct.pack('B',int(pc_state)))
-							sample_count += 1
-						
-						ticks += 1
-					# Unmangled waveform, OGG will make it jaggy
-					return pc_pcm.getvalue(), samplerate, sample_count
+			# The timer chip only ever changes state on a tick where a note starts or a sample is taken, so a half period is
+			# really the counter value rounded up to the sample grid. That makes the output of each note an arithmetic sequence of
+			# toggles that can be worked out directly, carrying the phase (last toggle tick) and speaker state over to the next note.
+			def ceil_to(ticks, step):
+				return -(-ticks // step) * step
+			# Last tick that gets looked at, the first note or sample tick at or after the end
+			last_tick = min(ceil_to(total_ticks - 1, sample_ticks), ceil_to(total_ticks - 1, note_ticks))
+			sample_count = last_tick // sample_ticks + 1
+			num_notes = last_tick // note_ticks + 1
+
+			# Per note: speaker state right after its first tick, first toggle after that, ticks between toggles, silent or not
+			note_state = np.empty(num_notes, dtype=np.int64)
+			note_first = np.empty(num_notes, dtype=np.int64)
+			note_period = np.ones(num_notes, dtype=np.int64)
+			note_silent = np.zeros(num_notes, dtype=bool)
+
+			def toggle(state, times=1):
+				if times == 0:
+					return state
+				# From silence the first toggle goes low, then alternate
+				if state == 128:
+					state = 128 + volume
+				return state if times % 2 == 0 else 256 - state
+
+			pc_state = 128 - volume
+			pc_count = 0
+			last_toggle = -1
+			note = 0
+			for i in range(num_notes):
+				tick = i * note_ticks
+				prev_count = pc_count
+				# Notes the counters table doesn't cover hold on to the last count for the rest of the sound, same as running out of notes
+				if note < len(self.raw) and self.raw[note] < len(counters):
+					pc_count = counters[self.raw[note]]
+					note += 1
+
+				if pc_count == 0:
+					pc_state = 128
+					note_silent[i] = True
+					continue
+				# Coming out of silence the count starts over at this tick
+				if prev_count == 0:
+					last_toggle = tick - 1
+				if tick - last_toggle - 1 >= pc_count:
+					pc_state = toggle(pc_state)
+					last_toggle = tick
+
+				first = ceil_to(last_toggle + pc_count + 1, sample_ticks)
+				period = ceil_to(pc_count + 1, sample_ticks)
+				note_state[i] = pc_state
+				note_first[i] = first
+				note_period[i] = period
+
+				end = min((i + 1) * note_ticks, last_tick + 1)
+				if first < end:
+					toggles = (end - 1 - first) // period + 1
+					last_toggle = first + (toggles - 1) * period
+					pc_state = toggle(pc_state, toggles)
+
+			ticks = np.arange(sample_count, dtype=np.int64) * sample_ticks
+			notes = ticks // note_ticks
+			first = note_first[notes]
+			toggles = np.where(ticks >= first, (ticks - first) // note_period[notes] + 1, 0)
+			state = note_state[notes]
+			# Same as toggle(), but for all the samples at once
+			base = np.where(state == 128, 128 + volume, state)
+			pcm = np.where(toggles % 2 == 0, base, 256 - base)
+			pcm = np.where(toggles == 0, state, pcm)
+			pcm = np.where(note_silent[notes], 128, pcm)
+			# Unmangled waveform, OGG will make it jaggy
+			return pcm.astype(np.uint8).tobytes(), samplerate, sample_count
 	
 	def to_format(self, format):
+		import numpy as np
+		import soundfile as sf
 		raw, samplerate, samples = self.to_pcmu8()
-		with io.BytesIO(raw) as data_file:
-			data_file.seek(0)
-			data, samplerate = sf.read(data_file, channels=1, samplerate=samplerate, frames=samples, subtype='PCM_U8', format='RAW')
-			with io.BytesIO() as out_file:
-				sf.write(out_file, data, samplerate, format=format)
-				return out_file.getvalue()
+		# View straight over the PCM_U8 bytes rather than having soundfile decode them as RAW into float64
+		pcm = np.frombuffer(raw, dtype=np.uint8, count=samples)
+		if format.upper() == 'OGG':
+			# Vorbis encodes from floats anyway, same scaling soundfile uses for PCM_U8
+			data = pcm.astype(np.float32)
+			data -= 128
+			data /= 128
+		else:
+			# Lossless formats get 16 bit integers (byte for byte the same output as going through floats)
+			data = pcm.astype(np.int16)
+			data -= 128
+			data <<= 8
+		with io.BytesIO() as out_file:
+			sf.write(out_file, data, samplerate, format=format)
+			return out_file.getvalue()
 	
 	def to_ogg(self):
 		return self.to_format('OGG')
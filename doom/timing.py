@@ -0,0 +1,168 @@
+# Named spans and counters to see where the time goes in long runs (--profile on the scripts)
+# Nothing is recorded unless enabled, spans are cheap enough to leave in place
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+enabled = False
+# (name, start, duration, pid, thread id) for every span, start is perf_counter seconds
+events = []
+# name -> {counter: value}
+counters = {}
+lock = threading.Lock()
+
+def enable():
+	global enabled
+	enabled = True
+	if not any(isinstance(finder, ImportTimer) for finder in sys.meta_path):
+		sys.meta_path.insert(0, ImportTimer())
+
+def reset():
+	del events[:]
+	counters.clear()
+
+@contextmanager
+def span(name):
+	if not enabled:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		with lock:
+			events.append((name, start, time.perf_counter() - start, os.getpid(), threading.get_ident()))
+
+# Times the imports done while enabled as 'import <package>' spans, which with everything imported lazily shows what each stage had to load
+# Only the outermost import is timed, whatever it imports in turn is part of it
+class ImportTimer():
+	depth = 0
+
+	def find_spec(self, name, path=None, target=None):
+		if not enabled or ImportTimer.depth:
+			return None
+		# Let the rest of the finders find it, then time the loading
+		for finder in sys.meta_path:
+			if finder is self or not hasattr(finder, 'find_spec'):
+				continue
+			spec = finder.find_spec(name, path, target)
+			if spec is not None:
+				break
+		else:
+			return None
+		if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+			spec.loader = TimedLoader(spec.loader)
+		return spec
+
+class TimedLoader():
+	def __init__(self, loader):
+		self.loader = loader
+
+	def __getattr__(self, key):
+		return getattr(self.loader, key)
+
+	def create_module(self, spec):
+		return self.loader.create_module(spec)
+
+	def exec_module(self, module):
+		# The module only ever sees its real loader
+		module.__spec__.loader = self.loader
+		module.__loader__ = self.loader
+		ImportTimer.depth += 1
+		try:
+			with span('import ' + module.__name__.split('.')[0]):
+				self.loader.exec_module(module)
+		finally:
+			ImportTimer.depth -= 1
+
+# Decorator version of span, named after the function unless given a name
+def timed(name=None):
+	from functools import wraps
+	def decorator(func):
+		span_name = name or func.__name__
+		@wraps(func)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return func(*args, **kwargs)
+			with span(span_name):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+def count(name, **values):
+	if not enabled:
+		return
+	with lock:
+		counter = counters.setdefault(name, {})
+		for key, value in values.items():
+			counter[key] = counter.get(key, 0) + value
+
+# Everything recorded so far, to be sent back from a worker process and merged into the parent with merge()
+def collect(clear=True):
+	with lock:
+		collected = (list(events), {name: dict(counter) for name, counter in counters.items()})
+		if clear:
+			reset()
+	return collected
+
+def merge(collected):
+	worker_events, worker_counters = collected
+	with lock:
+		events.extend(worker_events)
+		for name, counter in worker_counters.items():
+			merged = counters.setdefault(name, {})
+			for key, value in counter.items():
+				merged[key] = merged.get(key, 0) + value
+
+# Per span name totals: count, total and max seconds
+def span_totals():
+	totals = {}
+	for name, start, duration, pid, tid in events:
+		total = totals.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+		total['count'] += 1
+		total['seconds'] += duration
+		total['max'] = max(total['max'], duration)
+	return totals
+
+def report():
+	lines = []
+	totals = span_totals()
+	if totals:
+		lines.append(f'{"span":<24} {"count":>8} {"total s":>10} {"mean ms":>10} {"max ms":>10}')
+		for name, total in sorted(totals.items(), key=lambda item: item[1]['seconds'], reverse=True):
+			lines.append(f'{name:<24} {total["count"]:>8} {total["seconds"]:>10.3f} {total["seconds"] / total["count"] * 1000:>10.2f} {total["max"] * 1000:>10.2f}')
+	if counters:
+		lines.append('')
+		lines.append(f'{"cached function":<24} {"calls":>8} {"hits":>8} {"misses":>8} {"hit %":>6} {"MB":>10} {"seconds":>10}')
+		for name, counter in sorted(counters.items()):
+			calls = counter.get('calls', 0)
+			hit_rate = counter.get('hits', 0) / calls * 100 if calls else 0
+			lines.append(f'{name:<24} {calls:>8} {counter.get("hits", 0):>8} {counter.get("misses", 0):>8} {hit_rate:>6.1f} '
+				f'{counter.get("bytes", 0) / 2 ** 20:>10.2f} {counter.get("seconds", 0):>10.3f}')
+	return '\n'.join(lines)
+
+def to_json():
+	return {'spans': span_totals(), 'counters': counters}
+
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+def to_chrome_trace():
+	trace = []
+	for name, start, duration, pid, tid in events:
+		trace.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': tid})
+	return {'traceEvents': trace}
+
+# Print the report, and write it to path as well if given. A path ending in .trace.json gets a Chrome trace (chrome://tracing, Perfetto) instead
+def save(path=None):
+	import json
+	print(report())
+	if not path:
+		return
+	if path.endswith('.trace.json'):
+		data = to_chrome_trace()
+	else:
+		data = to_json()
+	with open(path, 'w') as fh:
+		json.dump(data, fh, indent='\t')
+	print('Profile written to: ' + path)
@@ -3,10 +3,21 @@
 def cache_data(func):
 	import hashlib
 	import os
+	import time
+	from functools import wraps
+	from doom import timing
 
+	# wraps() keeps the cached function picklable by name, so it can be handed to a multiprocessing Pool
+	# Calls, hits, misses, bytes and seconds are counted per function when timing is enabled
+	@wraps(func)
 	def wrapper(*data_args):
+		start = time.perf_counter()
 		m = hashlib.md5()
 		for data_arg in data_args:
+			# Objects can provide their own digest to avoid hashing (or repr of) all their data
+			if getattr(data_arg, 'digest', None) is not None:
+				m.update(data_arg.digest)
+				continue
 			try:
 				m.update(data_arg)
 			except TypeError:
@@ -17,30 +28,81 @@ def cache_data(func):
 		checksum = m.hexdigest()
 		#print(checksum)
 		#return b''
-		path = os.path.join('_cache', checksum + '_' + func.__name__)
+		path = os.path.join(cache_data.path, checksum + '_' + func.__name__)
+		memory = cache_data.memory
+		if memory is not None and func.__name__ not in cache_data.invalidate:
+			data = memory.get(os.path.abspath(path))
+			if data is not None:
+				timing.count(func.__name__, calls=1, hits=1, bytes=len(data), seconds=time.perf_counter() - start)
+				return data
 		try:
 			with open(path, 'rb') as fh:
 				if func.__name__ in cache_data.invalidate:
 					print('Invalidating cache: ' + path)
 					raise FileNotFoundError
-				return fh.read()
+				data = fh.read()
+			timing.count(func.__name__, calls=1, hits=1, bytes=len(data), seconds=time.perf_counter() - start)
 		except FileNotFoundError:
-			os.makedirs('_cache', exist_ok=True)
+			os.makedirs(cache_data.path, exist_ok=True)
 			data = func(*data_args)
 			with open(path, 'wb') as fh:
 				fh.write(data)
-			return data
+			timing.count(func.__name__, calls=1, misses=1, bytes=len(data), seconds=time.perf_counter() - start)
+		if memory is not None:
+			memory.put(os.path.abspath(path), data)
+		return data
 	return wrapper
 # Append to this list the name of any function that is being actively tweaked so old cache data doesn't get used
 cache_data.invalidate = []
+# Where cached data goes, relative to the working directory unless made absolute
+cache_data.path = '_cache'
+# Set to a MemoryCache to keep recent results in memory as well, see doom.daemon
+cache_data.memory = None
+
+# Least recently used data goes first once over max_bytes
+class MemoryCache():
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		# Insertion ordered, oldest first
+		self.data = {}
+
+	def get(self, key):
+		data = self.data.pop(key, None)
+		if data is not None:
+			self.data[key] = data
+		return data
+
+	def put(self, key, data):
+		if key in self.data:
+			self.bytes -= len(self.data.pop(key))
+		if len(data) > self.max_bytes:
+			return
+		self.data[key] = data
+		self.bytes += len(data)
+		while self.bytes > self.max_bytes:
+			self.bytes -= len(self.data.pop(next(iter(self.data))))
+
+	def clear(self):
+		self.data.clear()
+		self.bytes = 0
+
+# Bytes that cache_data knows by a digest given up front, like the pixel digest of an encoded image
+class DigestedBytes(bytes):
+	def __new__(cls, data, digest=None):
+		obj = super().__new__(cls, data)
+		obj.digest = digest
+		return obj
 
 def save_data(data, path):
 	import os
-	dirpath = os.path.dirname(path)
-	if dirpath:
-		os.makedirs(dirpath, exist_ok=True)
-	with open(path, 'wb') as fh:
-		fh.write(data)
+	from doom import timing
+	with timing.span('write'):
+		dirpath = os.path.dirname(path)
+		if dirpath:
+			os.makedirs(dirpath, exist_ok=True)
+		with open(path, 'wb') as fh:
+			fh.write(data)
 
 def load_data(path):
 	with open(path, 'rb') as fh:
@@ -48,13 +110,19 @@ def load_data(path):
 
 def id_iwad(gzdoom, iwad):
 	from os.path import basename
+	from copy import deepcopy
 	from doom.info import Iwadinfo
-	iwad_ref = Iwadinfo(gzdoom['iwadinfo'])
-	if not iwad.has_lump('iwadinfo'):
-		iwad_id = iwad_ref.identify(basename(iwad.path), lambda lump_name : iwad.has_lump(lump_name))
-	else:
-		iwad_id = Iwadinfo(iwad['iwadinfo'])
-	return iwad_id
+	if 'iwadinfo' in iwad.lump_names():
+		return Iwadinfo(iwad['iwadinfo'])
+	# Parsed once per gzdoom.pk3
+	iwad_ref = id_iwad.references.get(gzdoom.digest)
+	if iwad_ref is None:
+		iwad_ref = Iwadinfo(gzdoom['iwadinfo'])
+		if gzdoom.digest:
+			id_iwad.references[gzdoom.digest] = iwad_ref
+	# Identification is kept by digest, so hand out a copy since callers like to rename it
+	return deepcopy(iwad_ref.identify(basename(iwad.path), iwad.lump_names(), iwad.digest))
+id_iwad.references = {}
 
 # https://stackoverflow.com/questions/20656135/python-deep-merge-dictionary-data
 def merge_dict(source, destination):
@@ -79,9 +147,70 @@ def chain_args(parser):
 	metavar=('IWAD', 'PWAD'),
 	help='Specify IWAD archive, with additional arguments as PWADs to it. (Can be IPK3/PK3 as well, not just wads) Can be used multiple times for filtering/merging commands.')
 
-def get_chains(args):
+# --profile for the scripts, see start_profile and end_profile
+def profile_args(parser):
+	parser.add_argument(
+	'--profile',
+	nargs='?',
+	const='',
+	metavar='PATH',
+	help='Time each stage and count cache hits, then print a report. '
+		'With a path, also write it as JSON, or as a Chrome trace (chrome://tracing, Perfetto) if the path ends in .trace.json.')
+
+def start_profile(args):
+	from doom import timing
+	if args.profile is not None:
+		timing.enable()
+
+def end_profile(args):
+	from doom import timing
+	if args.profile is not None:
+		timing.save(args.profile)
+
+# -daemon for the scripts, see forward_daemon
+def daemon_args(parser):
+	parser.add_argument(
+	'-daemon',
+	metavar='SOCKET',
+	help='Run on a daemon started with daemon.py listening on this socket, instead of in this process.')
+
+# Hand the whole command over to the daemon if asked to, exiting with its result
+def forward_daemon(args, script):
+	import sys
+	from doom.daemon import submit
+	if not args.daemon:
+		return
+	argv = sys.argv[1:]
+	for i, arg in enumerate(argv):
+		if arg == '-daemon':
+			del argv[i:i + 2]
+			break
+		if arg.startswith('-daemon='):
+			del argv[i]
+			break
+	exit(submit(args.daemon, script, argv))
+
+# Pool initializer for anything that doesn't need its own, so workers record timing when the parent does
+def pool_profile_init(profile):
+	from doom import timing
+	# Forked workers start with a copy of whatever the parent recorded so far
+	timing.reset()
+	if profile:
+		timing.enable()
+
+# For Pool.map and friends, call func(arg) in the worker and bring back whatever timing recorded there for timing.merge()
+def pool_profiled(call):
+	from doom import timing
+	func, arg = call
+	result = func(arg)
+	return result, timing.collect() if timing.enabled else None
+
+# Archives are opened all at once in threads, with prefetch they're fully indexed up front too (WADs in processes) rather than on first use
+def get_chains(args, prefetch=False):
 	from os.path import isfile
-	from doom.archive import get_archive
+	from concurrent.futures import ThreadPoolExecutor
+	from doom.archive import Wad, get_archive, prefetch_wads
+	from doom import timing
 	
 	# TODO: Find GZDoom more intelligently in a cross-platform way
 	if not args.gzdoom:
@@ -91,13 +220,29 @@ def get_chains(args):
 			print('Cannot find a gzdoom.pk3!')
 			exit(1)
 
+	# Need a new gzdoom for each chain to do filtering
+	# TODO: Could probably do this without copies.
+	paths = [path for chain_paths in args.iwad for path in [args.gzdoom] + chain_paths]
+	with timing.span('open archives'):
+		with ThreadPoolExecutor() as executor:
+			opened = list(executor.map(get_archive, paths))
+			grouped = []
+			for chain_paths in args.iwad:
+				chain = opened[:len(chain_paths) + 1]
+				del opened[:len(chain_paths) + 1]
+				# PWADs without a PNAMES of their own recognize patches by the last one before them in the chain, so this goes in order
+				patch_names = None
+				for archive in chain:
+					archive.patch_names = patch_names
+					patch_names = archive.chain_patch_names(patch_names)
+				grouped.append(chain)
+			if prefetch:
+				archives = [archive for chain in grouped for archive in chain]
+				prefetch_wads([archive for archive in archives if isinstance(archive, Wad)])
+				list(executor.map(lambda archive: archive.prefetch(), archives))
+
 	chains = []
-	for chain_paths in args.iwad:
-		# Need a new gzdoom for each chain to do filtering
-		# TODO: Could probably do this without copies.
-		chain = [get_archive(args.gzdoom)]
-		for path in chain_paths:
-			chain.append(get_archive(path))
+	for chain in grouped:
 		iwad_id = id_iwad(chain[0], chain[1])
 		print('IWAD identified as "' + iwad_id['Name'] + '"')
 		for i in range(len(chain)):
@@ -122,10 +267,13 @@ def commonize_filters(old, new):
 # https://stackoverflow.com/questions/1855095/how-to-create-a-zip-archive-of-a-directory
 # TODO: Support true 7zip?
 # TODO: Make thread safe? Don't like chdir
-def mkzip(zip_path, dir_path, exclude=[], method='stored'):
+# members are headers by their path in the zip, copied over from their archive as they are (see Archive.copy_member) instead of the file on disk
+def mkzip(zip_path, dir_path, exclude=[], method='stored', members={}):
 	import zipfile
-	from os import walk, chdir, getcwd
-	from os.path import join, abspath, relpath
+	from os import walk, chdir, getcwd, sep
+	from os.path import join, abspath, relpath, normpath
+	from doom import timing
+	from doom.archive import ZipWriter
 
 	method = method.lower()
 	if method.startswith('store'):
@@ -145,22 +293,29 @@ def mkzip(zip_path, dir_path, exclude=[], method='stored'):
 	chdir(dir_path)
 	dir_path = relpath(dir_path)
 	
-	zipf = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
-	for root, dirs, files in walk(dir_path):
-		# https://stackoverflow.com/questions/19859840/excluding-directories-in-os-walk
-		dirs[:] = [d for d in dirs if d not in exclude]
-		for file in files:
-			zipf.write(join(root, file))
-	zipf.close()
+	with timing.span('mkzip'):
+		with ZipWriter(zip_path) as zipw:
+			copied = set()
+			with timing.span('copy members'):
+				for arcname, header in members.items():
+					if header['archive'].copy_member(header['handle'], zipw, arcname):
+						copied.add(arcname)
+			for root, dirs, files in walk(dir_path):
+				# https://stackoverflow.com/questions/19859840/excluding-directories-in-os-walk
+				dirs[:] = [d for d in dirs if d not in exclude]
+				for file in files:
+					if normpath(join(root, file)).replace(sep, '/') not in copied:
+						zipw.write_file(join(root, file))
 
 	chdir(oldcd)
 
 # Yield textureinfos for 'final' view of textures. Skips sprites, graphics, flats that are overidden by textures or replaced by hires.
+# with_digest adds a 'digest' of the pixels (see pixel_digest) and a perceptual 'dhash', straight from the decoded image
 # TODO: Add filter from arhive
-# TODO: Parse TEXTURES lump
-def gen_textures(archive, palette, with_noncomposites=False, with_data=True, to_png=True, hacks=True):
-	from doom.graphic import ZImage, texture_to_png, lump_to_png
-	from doom.info import TextureX, PNames, TextureInfo
+def gen_textures(archive, palette, with_noncomposites=False, with_data=True, to_png=True, hacks=True, with_digest=False):
+	from doom.graphic import ZImage, texture_to_png, lump_to_png, texture_to_rgba, image_to_rgba, rgba_digests
+	from doom.info import TextureX, PNames, TextureInfo, Textures
+	from os.path import splitext
 	from copy import deepcopy
 	
 	if with_noncomposites:
@@ -199,7 +354,8 @@ def gen_textures(archive, palette, with_noncomposites=False, with_data=True, to_
 						# Overidden by a texture, just wait for the texture
 						continue
 					elif name in namespaces['hires']:
-						zimg_hi = ZImage(namespaces['hires'][name]['get_data'](), convert=False)
+						hires_data = namespaces['hires'][name]['get_data']()
+						zimg_hi = ZImage(hires_data, palette, convert=False)
 						width = zimg_hi.width
 						height = zimg_hi.height
 						XScale = zimg_hi.width / zimg.width
@@ -208,7 +364,7 @@ def gen_textures(archive, palette, with_noncomposites=False, with_data=True, to_
 						topoffset = int(zimg.topoffset * YScale)
 						offset = (leftoffset, topoffset)
 						if with_data:
-							data = namespaces['hires'][name]['data']
+							data = hires_data
 						# Delete it so it doesn't get reprocessed as a texture
 						# Note this means only one lump can be replaced, which is slightly different than in GZDoom that replaces all of same name
 						# regardless of namespace (though I think that is buggy/unexpected behavior)
@@ -218,6 +374,8 @@ def gen_textures(archive, palette, with_noncomposites=False, with_data=True, to_
 				texture = TextureInfo(name.upper(), width, height, [], namespace=ttype, Offset=offset, XScale=XScale, YScale=YScale)
 				if with_data:
 					texture['data'] = data
+					if with_digest:
+						texture['digest'], texture['dhash'] = rgba_digests(image_to_rgba(data, palette), texture['Offset'])
 					if to_png:
 						texture['data'] = lump_to_png(data, palette)
 
@@ -229,17 +387,64 @@ def gen_textures(archive, palette, with_noncomposites=False, with_data=True, to_
 			if with_data:
 				for i in range(len(texture['patches'])):
 					texture['patches'][i]['data'] = archive[texture['patches'][i]['name']]
+				if with_digest:
+					texture['digest'], texture['dhash'] = rgba_digests(texture_to_rgba(texture, palette), texture['Offset'])
 				if to_png:
 					texture['data'] = texture_to_png(texture, palette)
 			yield texture
-	if archive.has_lump('textures'):
-		pass
+	if archive.has_lump('textures', 'global'):
+		# Every lump by name, for patches and includes. Later archives take priority
+		lumps = {}
+		for header in archive.headers():
+			lumps.setdefault(header['name'], []).append(header)
+		
+		# Either a full path into a PK3 or just a lump name, the name is the filename without the extension
+		def find_lump(path):
+			path = path.replace('\\', '/').lower()
+			headers = lumps.get(splitext(path.split('/')[-1])[0], [])
+			for header in reversed(headers):
+				if isinstance(header['handle'], str) and header['handle'].lower() == path:
+					return header['get_data']()
+			if headers:
+				return headers[-1]['get_data']()
+			return None
+		
+		# All TEXTURES lumps are used (textures.txt, textures.wood...), in load order
+		for header in lumps.get('textures', []):
+			if header['namespace'] != 'global':
+				continue
+			for texture in Textures(header['get_data'](), include=find_lump):
+				texture['lump'] = 'textures'
+				if with_data:
+					patches = []
+					for patch in texture['patches']:
+						patch['data'] = find_lump(patch['name'])
+						if patch['data'] is None:
+							print(f'Could not find patch {patch["name"]} for {texture["name"]}. Skipping.')
+							continue
+						patches.append(patch)
+					texture['patches'] = patches
+					if with_digest:
+						texture['digest'], texture['dhash'] = rgba_digests(texture_to_rgba(texture, palette), texture['Offset'])
+					if to_png:
+						texture['data'] = texture_to_png(texture, palette)
+				yield texture
+
+# PNG for a texture from gen_textures(to_png=False), noncomposites have their lump as data
+def texture_png(texture, palette):
+	from doom.graphic import texture_to_png, lump_to_png
+	if 'data' in texture:
+		return lump_to_png(texture['data'], palette)
+	return texture_to_png(texture, palette)
 
 # Take list of namespaces representing the same namespace, e.g. 'sprites' from differing IWADS
 # and consolidate them using their filters.
 # Detect duplicates and commonize their filters.
 # Returns list of filtered headers
-def filter_namespace(namespaces):
+# Headers with a 'digest' are compared by that instead of their data.
+# With similarity (images only), groups that decode to the same pixels are merged, and groups whose perceptual hashes are
+# within that many bits of each other (with the same size and offsets) are reported as near duplicates. merge_similar merges those too.
+def filter_namespace(namespaces, similarity=None, merge_similar=False):
 	import hashlib
 	names = set()
 	for namespace in namespaces:
@@ -254,13 +459,15 @@ def filter_namespace(namespaces):
 		if len(headers) > 1:
 			by_csum = {}
 			for header in headers:
-				csum = hashlib.md5(header['data']).hexdigest()
+				csum = header['digest'] if 'digest' in header else hashlib.md5(header['data']).hexdigest()
 				if csum not in by_csum:
 					by_csum[csum] = []
 				by_csum[csum].append(header)
 
 			by_val = list(by_csum.values())
 			by_val.sort(key=len, reverse=True)
+			if similarity is not None and len(by_val) > 1:
+				by_val = merge_similar_groups(name, by_val, similarity, merge_similar)
 			filters = []
 			for dups in by_val:
 				if len(dups) == 1:
@@ -281,19 +488,53 @@ def filter_namespace(namespaces):
 			filtered.append(headers[0])
 	return filtered
 
+# Merge groups of image headers (each group already byte for byte identical) that are the same or close enough, largest group first
+def merge_similar_groups(name, groups, similarity, merge_similar):
+	from doom.graphic import image_pixel_digest, image_dhash, hash_distance
+	
+	# Exact pixels first, different bytes can still decode to the same image (already the case for groups by digest)
+	if 'digest' not in groups[0][0]:
+		by_pixels = {}
+		for group in groups:
+			digest = image_pixel_digest(group[0]['data'], group[0].get('Offset', (0, 0)))
+			by_pixels.setdefault(digest, []).extend(group)
+		groups = list(by_pixels.values())
+		groups.sort(key=len, reverse=True)
+	
+	merged = []
+	for group in groups:
+		header = group[0]
+		layout = (header.get('width'), header.get('height'), header.get('Offset'))
+		dhash = header['dhash'] if 'dhash' in header else image_dhash(header['data'])
+		for kept, kept_layout, kept_dhash in merged:
+			distance = hash_distance(dhash, kept_dhash)
+			if layout == kept_layout and distance <= similarity:
+				print(f'{name}: {", ".join(dup["filter"] for dup in group)} looks like {kept[0]["filter"]} (distance {distance})' +
+					(', merging' if merge_similar else ''))
+				if merge_similar:
+					kept.extend(group)
+					break
+		else:
+			merged.append((group, layout, dhash))
+	return [group for group, _, _ in merged]
+
 # Take lists of headers belonging to the same namespace, e.g. 'patches' from two different IWADs
 # and consolidate them using a renaming scheme
 # Returns namespace
 def rename_namespace():
 	pass
 
-def extract(chain, path=None, with_iwad=False, modernize=False):
+# members, if given, gets the headers that are extracted unchanged by their path in the output, for mkzip to copy as they are
+def extract(chain, path=None, with_iwad=False, modernize=False, members=None):
+	from os import sep
 	from os.path import basename, splitext, join
 	from shutil import rmtree
 	from doom.archive import Archives
+	from doom import timing
 	if modernize:
 		from doom.graphic import lump_to_png, texture_to_png
 		from doom.sound import lump_to_sound
+		from doom.music import lump_to_music
 		from doom.info import Palette, PNames, TextureX
 	
 	pwad_only = False
@@ -320,30 +561,47 @@ def extract(chain, path=None, with_iwad=False, modernize=False):
 	rmtree(path, ignore_errors=True)
 	
 	for header in archive:
+		original = header['data']
 		if modernize:
 			# Handled as a group, convert to TEXTURES
 			if header['name'].lower() in ['texture1', 'texture2', 'pnames']:
 				continue
 			
-			if palette and header['extension'] != 'png' and header['namespace'] in ['sprites', 'graphics', 'patches', 'flats', 'textures', 'hires']:
-				try:
-					header['data'] = lump_to_png(header['data'], palette)
-					header['extension'] = 'png'
-				except:
-					print(f'Could not identify {header["name"]} as an image (likely a PIL limitation). Skipping.')
-			if header['extension'] == 'lmp' and header['namespace'] in ['sounds']:
-				header['data'] = lump_to_sound(header['data'], fmt='flac', skip_pc=False)
-				header['extension'] = 'flac'
+			with timing.span('convert'):
+				if palette and header['extension'] != 'png' and header['namespace'] in ['sprites', 'graphics', 'patches', 'flats', 'textures', 'hires']:
+					try:
+						header['data'] = lump_to_png(header['data'], palette)
+						header['extension'] = 'png'
+					except:
+						print(f'Could not identify {header["name"]} as an image (likely a PIL limitation). Skipping.')
+				if header['extension'] == 'lmp' and header['namespace'] in ['sounds']:
+					header['data'] = lump_to_sound(header['data'], fmt='flac', skip_pc=False)
+					header['extension'] = 'flac'
+				if header['extension'] == 'lmp' and header['namespace'] in ['music']:
+					# Anything that isn't MUS (MIDI, OGG, trackers) is already playable, leave it be
+					midi = lump_to_music(header['data'], fmt='mid')
+					if midi:
+						header['data'] = midi
+						header['extension'] = 'mid'
 
 		extension = '.' + header['extension'] if header['extension'] else ''
-		save_data(header['data'], join(path, header['namespace'] if header['namespace'] != 'global' else '', header['name'].lower() + extension))
+		lump_path = join(header['namespace'] if header['namespace'] != 'global' else '', header['name'].lower() + extension)
+		save_data(header['data'], join(path, lump_path))
+		if members is not None:
+			if header['data'] is original:
+				members[lump_path.replace(sep, '/')] = header
+			else:
+				members.pop(lump_path.replace(sep, '/'), None)
 	
 	if modernize:
 		# No hacks cause I think even a semi-accurate 'extraction' should be warts and all
 		textures_str = ''
-		for texture in gen_textures(archive, palette, hacks=False):
-			save_data(texture_to_png(texture, palette), join(path, 'composite', texture['namespace'].lower() + 's', texture['name'].lower() + '.png'))
-			textures_str += str(texture) + '\n'
+		with timing.span('composites'):
+			for texture in gen_textures(archive, palette, hacks=False):
+				save_data(texture_to_png(texture, palette), join(path, 'composite', texture['namespace'].lower() + 's', texture['name'].lower() + '.png'))
+				# TEXTURES lumps are already extracted as they are
+				if texture.get('lump') != 'textures':
+					textures_str += str(texture) + '\n'
 		# Include rebuilt TEXTURES lump if TEXTUREX was used in any capacity
 		if archive.has_lump('texture1') and archive.has_lump('pnames'):
 			save_data(textures_str.encode(), join(path, 'textures.txt'))
@@ -362,11 +620,15 @@ def extract(chain, path=None, with_iwad=False, modernize=False):
 	return path
 
 
-def pool_init(l, gpu):
-	from doom.graphic import png_to_waifu2x
+def pool_init(l, gpu, settings=None, profile=False):
+	from doom.graphic import png_to_waifu2x, superscale
 	global lock
 	lock = l
 	png_to_waifu2x.gpu = gpu
+	# Spawned workers start with the defaults
+	if settings:
+		superscale.settings = settings
+	pool_profile_init(profile)
 
 def pool_lock():
 	try:
@@ -380,13 +642,26 @@ def pool_unlock():
 	except:
 		pass
 
+# Key for a hires output, anything that would change the scaled image or its definition
+def hires_key(texture):
+	import hashlib
+	m = hashlib.md5(texture['digest'])
+	m.update(repr([(key, value) for key, value in sorted(texture.items()) if key not in ['data', 'patches', 'palette', 'digest']]).encode())
+	return m.hexdigest()
+
 # TODO: Support scaling gzdoom resources as well
-def hires(chains, path=None, scale=2, cpu=1):
-	from os.path import basename, splitext, join
+# With incremental, a previous build in path is updated in place using its manifest (path + '.json'):
+# only textures whose key changed are scaled again, outputs that are gone get removed, and unchanged textures.hires are left alone
+# memory (in MB) caps how much each worker should use to scale a single image, bigger ones are scaled in tiles
+def hires(chains, path=None, scale=2, cpu=1, incremental=False, similarity=None, merge_similar=False, memory=None):
+	import json
+	from os import remove
+	from os.path import basename, splitext, join, isfile
 	from shutil import rmtree
 	from doom.archive import Archives
-	from doom.graphic import  superscale, png_to_waifu2x
+	from doom.graphic import  superscale, superscale_info, png_to_waifu2x
 	from doom.info import Palette, PatchInfo
+	from doom import timing
 	
 	if not path:
 		names = ''
@@ -395,7 +670,24 @@ def hires(chains, path=None, scale=2, cpu=1):
 				names += splitext(basename(archive.path))[0] + '_'
 		names = names[:-1]
 		path = join('out', names + '_hires[' + str(scale) + 'x]')
-	rmtree(path, ignore_errors=True)
+	
+	superscale.settings['memory'] = memory
+	
+	manifest_path = path.rstrip('/\\') + '.json'
+	manifest = {'settings': superscale.settings, 'outputs': {}}
+	previous = {}
+	if incremental:
+		try:
+			with open(manifest_path) as fh:
+				previous = json.load(fh)
+		except (FileNotFoundError, ValueError):
+			pass
+		# Different settings means every output is different
+		if previous.get('settings') != superscale.settings:
+			previous = {}
+	if not previous:
+		rmtree(path, ignore_errors=True)
+	previous = previous.get('outputs', {})
 	
 	all_namespaces = []
 	for chain in chains:
@@ -404,40 +696,80 @@ def hires(chains, path=None, scale=2, cpu=1):
 		palette = Palette(archive['playpal'])
 		
 		namespaced = {ns:{} for ns in ['Sprite', 'Graphic', 'Flat', 'WallTexture', 'Texture']}
-		# Get all the data at once for filtering. To PNG as well, since it seems Doom graphics between Doom 1/2 can be different yet render to the same image.
-		for texture in gen_textures(archive, palette, with_noncomposites=True, with_data=True, to_png=True, hacks=True):
-			texture['filter'] = chain[0].game
-			texture['scale'] = scale
-			namespaced[texture['namespace']][texture['name']] = texture
+		# Get all the data at once for filtering. Compared by pixel digest, since it seems Doom graphics between Doom 1/2 can be different yet render to the same image.
+		# PNGs are only made for whatever is left to scale after filtering
+		with timing.span('gen_textures'):
+			for texture in gen_textures(archive, palette, with_noncomposites=True, with_data=True, to_png=False, hacks=True, with_digest=True):
+				texture['filter'] = chain[0].game
+				texture['scale'] = scale
+				texture['palette'] = palette
+				namespaced[texture['namespace']][texture['name']] = texture
 		all_namespaces.append(namespaced)
 
 	to_scale = []
 	for ns_name in ['Sprite', 'Graphic', 'Flat', 'WallTexture', 'Texture']:
 		print('Filtering...')
-		to_scale += filter_namespace([gr_ns[ns_name] for gr_ns in all_namespaces])
+		with timing.span('filter_namespace'):
+			to_scale += filter_namespace([gr_ns[ns_name] for gr_ns in all_namespaces], similarity, merge_similar)
 
+	def patch_paths(texture):
+		return ('patches', texture['namespace'].lower() + 's', texture['name'].replace('\\','^').lower() + '.png')
+	
+	# Skip anything that was already scaled from the same input
+	unchanged = []
+	changed = []
+	for texture in to_scale:
+		output = '/'.join(('filter', texture['filter']) + patch_paths(texture))
+		key = hires_key(texture)
+		manifest['outputs'][output] = key
+		if previous.get(output) == key and isfile(join(path, output)):
+			unchanged.append(texture)
+		else:
+			# Scaling caches go by the pixel digest as well
+			with timing.span('png encode'):
+				texture['data'] = DigestedBytes(texture_png(texture, texture['palette']), texture['digest'])
+			changed.append(texture)
+		del texture['palette']
+	if incremental:
+		print(f'{len(unchanged)} unchanged, {len(changed)} to scale')
+	
 	textures = []
-	def post_scale(texture):
-		patch_paths = ('patches', texture['namespace'].lower() + 's', texture['name'].replace('\\','^').lower() + '.png')
-		save_data(texture['data'], join(path, 'filter', texture['filter'], *patch_paths))
-		texture['patches'] = [PatchInfo('/'.join(patch_paths), 0, 0)]
+	def post_scale(texture, save=True):
+		if save:
+			save_data(texture['data'], join(path, 'filter', texture['filter'], *patch_paths(texture)))
+		texture['patches'] = [PatchInfo('/'.join(patch_paths(texture)), 0, 0)]
 		# Try to save memory
-		del texture['data']
+		texture.pop('data', None)
 		textures.append(texture)
 
+	for texture in unchanged:
+		if scale > 1:
+			superscale_info(texture)
+		post_scale(texture, save=False)
+	
 	if scale > 1 and cpu > 1:
 		# https://stackoverflow.com/questions/25557686/python-sharing-a-lock-between-processes
 		from multiprocessing import Pool, Lock
 		l = Lock()
-		pool = Pool(processes=cpu, initializer=pool_init, initargs=(l,png_to_waifu2x.gpu))
-		for texture in pool.imap_unordered(superscale, to_scale):
+		pool = Pool(processes=cpu, initializer=pool_init, initargs=(l,png_to_waifu2x.gpu,superscale.settings,timing.enabled))
+		for texture, collected in pool.imap_unordered(pool_profiled, [(superscale, texture) for texture in changed]):
+			if collected:
+				timing.merge(collected)
 			post_scale(texture)
 	else:
-		for texture in to_scale:
+		for texture in changed:
 			if scale > 1:
 				# TODO: superscale should modify width, height, adjust offsets, etc.
 				texture = superscale(texture)
 			post_scale(texture)
+	
+	# Outputs from the last build that aren't in this one
+	for output in previous:
+		if output not in manifest['outputs']:
+			try:
+				remove(join(path, output))
+			except FileNotFoundError:
+				pass
 
 	# TODO: Generate texture definitions per IWAD with this list
 	textures.sort()
@@ -458,18 +790,27 @@ def hires(chains, path=None, scale=2, cpu=1):
 		texturedef = ''
 		for texture in gametextures:
 			texturedef += str(texture) + '\n'
-		save_data(texturedef.encode(), join(path, 'filter', chain[0].game, 'textures.hires'))
+		texturedef_path = join(path, 'filter', chain[0].game, 'textures.hires')
+		try:
+			if load_data(texturedef_path) == texturedef.encode():
+				continue
+		except FileNotFoundError:
+			pass
+		save_data(texturedef.encode(), texturedef_path)
 	
+	save_data(json.dumps(manifest, indent='\t', sort_keys=True).encode(), manifest_path)
 	print('Extracted to: ' + path)
 	return path
 	
 # Replace the normal sounds with "rendered" PC speaker ones
-def bleeps(chains, path=None):
+def bleeps(chains, path=None, cpu=1):
 	from os.path import basename, splitext, join
 	from shutil import rmtree
+	from hashlib import md5
 	from difflib import get_close_matches
 	from doom.archive import Archives
 	from doom.sound import Dmx, dmx_to_ogg
+	from doom import timing
 	
 	if not path:
 		names = ''
@@ -480,28 +821,60 @@ def bleeps(chains, path=None):
 		path = join('out', names + '_bleeps')
 	rmtree(path, ignore_errors=True)
 	
-	all_namespaces = []
+	# Gather up the PC sounds of every chain first, the same DP* lumps show up in most IWADs so only render each one once
+	renders = {}
+	chain_sounds = []
 	for chain in chains:
 		print('Processing: ' + chain[0].game)
 		archive = Archives(*chain[1:])
 		
 		sound_ns = {}
-		pc_names = []
 		dig_names = []
-		for header in archive:
-			if header['extension'] == 'lmp' and header['namespace'] in ['sounds']:
-				sound = Dmx(header['data'])
-				if sound.is_pc():
-					header['data'] = dmx_to_ogg(header['data'])
-					header['extension'] = 'ogg'
-					sound_ns[header['name']] =  header
-					pc_names.append(header['name'])
-				else:
-					dig_names.append(header['name'])
+		with timing.span('collect sounds'):
+			for header in archive:
+				if header['extension'] == 'lmp' and header['namespace'] in ['sounds']:
+					sound = Dmx(header['data'])
+					if sound.is_pc():
+						header['digest'] = md5(header['data']).hexdigest()
+						renders[header['digest']] = header['data']
+						sound_ns[header['name']] =  header
+					else:
+						dig_names.append(header['name'])
+		chain_sounds.append((sound_ns, dig_names))
+
+	print('Rendering ' + str(len(renders)) + ' PC sounds...')
+	digests = list(renders)
+	with timing.span('render'):
+		if cpu > 1:
+			from multiprocessing import Pool
+			with Pool(processes=cpu, initializer=pool_profile_init, initargs=(timing.enabled,)) as pool:
+				oggs = []
+				for ogg, collected in pool.map(pool_profiled, [(dmx_to_ogg, renders[digest]) for digest in digests]):
+					if collected:
+						timing.merge(collected)
+					oggs.append(ogg)
+		else:
+			oggs = [dmx_to_ogg(renders[digest]) for digest in digests]
+	renders = dict(zip(digests, oggs))
+
+	all_namespaces = []
+	for sound_ns, dig_names in chain_sounds:
+		for header in sound_ns.values():
+			header['data'] = renders[header['digest']]
+			header['extension'] = 'ogg'
 
 		# Find digital name equivalents
-		for pc_name in set(pc_names):
-			matches = get_close_matches(pc_name, dig_names)
+		# PC sounds are normally just the digital name with 'DP' instead of 'DS', which is also always difflib's best match when it exists.
+		# So look those up directly and only fall back to difflib for the odd ones out.
+		by_suffix = {}
+		for name in dig_names:
+			# difflib breaks ties with the larger name
+			by_suffix[name[2:]] = max(by_suffix.get(name[2:], name), name)
+		for pc_name in list(sound_ns):
+			if len(pc_name) > 2 and pc_name[2:] in by_suffix:
+				matches = [by_suffix[pc_name[2:]]]
+			else:
+				matches = get_close_matches(pc_name, dig_names)
 			# if no match just skip
 			if not matches:
 				print(f'Can\'t find a digital name match for {pc_name}. Skipping.')
@@ -513,9 +886,92 @@ def bleeps(chains, path=None):
 
 		all_namespaces.append(sound_ns)
 
-	filtered = filter_namespace(all_namespaces)
+	with timing.span('filter_namespace'):
+		filtered = filter_namespace(all_namespaces)
 	for header in filtered:
 		save_data(header['data'], join(path, 'filter', header['filter'], 'sounds', header['name'].lower() + '.' + header['extension']))
 
 	print('Extracted to: ' + path)
 	return path
+
+# Combine IWADs (or map packs) into one filtered package that works with any of the chains
+# Chains with PWADs only contribute the PWADs (map packs), unless with_iwad
+# Every lump body is kept once by its md5, so reading the chains never holds more than the distinct data in memory.
+# Bodies the games have in common get written once to the common filter (or the root if there is none), the rest go to filter/<game>/
+# members works like it does for extract
+def smoosh(chains, path=None, with_iwad=False, members=None):
+	from os import sep
+	from os.path import basename, splitext, join
+	from shutil import rmtree
+	from hashlib import md5
+	from doom.archive import Archives
+	from doom import timing
+	
+	def contents(chain):
+		return chain[2:] if len(chain) > 2 and not with_iwad else chain[1:]
+	
+	if not path:
+		names = ''
+		for chain in chains:
+			for archive in contents(chain):
+				names += splitext(basename(archive.path))[0] + '_'
+		names = names[:-1]
+		path = join('out', names + '_smoosh')
+	rmtree(path, ignore_errors=True)
+	
+	bodies = {}
+	all_namespaces = {}
+	total_lumps = 0
+	total_bytes = 0
+	for chain in chains:
+		print('Processing: ' + chain[0].game)
+		with timing.span('read lumps'):
+			for namespace, headers in Archives(*contents(chain)).namespaces().items():
+				for header in headers.values():
+					data = header['get_data']()
+					header['digest'] = md5(data).hexdigest()
+					bodies.setdefault(header['digest'], data)
+					total_lumps += 1
+					total_bytes += len(data)
+				all_namespaces.setdefault(namespace, []).append(headers)
+	
+	written = {}
+	written_lumps = 0
+	written_bytes = 0
+	games = [chain[0].game for chain in chains]
+	for namespace, namespaces in all_namespaces.items():
+		with timing.span('filter_namespace'):
+			filtered = []
+			for header in filter_namespace(namespaces):
+				# A common filter also reaches the games that don't have the lump at all, those get their own copies instead
+				covered = [i for i, game in enumerate(games) if game.startswith(header['filter'])]
+				if all(header['name'] in namespaces[i] for i in covered):
+					filtered.append(header)
+					continue
+				for i in covered:
+					dup = namespaces[i].get(header['name'])
+					if dup and dup['digest'] == header['digest']:
+						dup['filter'] = games[i]
+						filtered.append(dup)
+		for header in filtered:
+			data = bodies[header['digest']]
+			extension = '.' + header['extension'] if header['extension'] else ''
+			filter_path = join('filter', header['filter']) if header['filter'] else ''
+			lump_path = join(filter_path, namespace if namespace != 'global' else '', header['name'].lower() + extension)
+			# Chains of the same game can still disagree, last one wins like it would in a chain
+			if lump_path in written:
+				print(f'{header["name"]} differs between chains of {header["filter"]}, keeping the last one.')
+				written_bytes -= written.pop(lump_path)
+				written_lumps -= 1
+			save_data(data, join(path, lump_path))
+			if members is not None:
+				members[lump_path.replace(sep, '/')] = header
+			written[lump_path] = len(data)
+			written_lumps += 1
+			written_bytes += len(data)
+	
+	saved = total_bytes - written_bytes
+	print(f'Smooshed {total_lumps} lumps ({total_bytes} bytes) into {written_lumps} ({written_bytes} bytes, {len(bodies)} distinct), '
+		f'saved {saved} bytes ({100 * saved / max(total_bytes, 1):.1f}%)')
+	print('Extracted to: ' + path)
+	return path
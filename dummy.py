@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+if __name__ == '__main__':
+	import argparse
+	from doom.dummy import dummy
+
+	parser = argparse.ArgumentParser(
+		description='Generate a dummy IWAD, PWAD or PK3 full of random (but valid) lumps, for testing at scale without the real IWADs. '
+			'Has marker namespaces, PNAMES/TEXTURE1 composites, Picture format graphics, DMX sounds, MUS music and maps. PK3s can have nested subarchives as well.'
+	)
+	parser.add_argument(
+		'-path',
+		help='File to write. A .wad or .iwad extension makes a WAD, anything else a PK3.',
+		default='out/dummy.wad'
+	)
+	parser.add_argument(
+		'-lumps',
+		help='Roughly how many lumps to generate.',
+		default=1000,
+		type=int
+	)
+	parser.add_argument(
+		'-textures',
+		help='How many composite textures to define in TEXTURE1, otherwise one per patch.',
+		type=int
+	)
+	parser.add_argument(
+		'-maps',
+		help='How many maps to include, otherwise one per thousand lumps.',
+		type=int
+	)
+	parser.add_argument(
+		'-nested',
+		help='How many subarchives to nest in a PK3.',
+		default=0,
+		type=int
+	)
+	parser.add_argument(
+		'-seed',
+		help='Dummies with different seeds have different data under the same lump names.',
+		default=0
+	)
+	parser.add_argument(
+		'-shared',
+		help='Fraction of lumps that stay the same whatever the seed, like the graphics IWADs have in common.',
+		default=0.0,
+		type=float
+	)
+	parser.add_argument(
+		'-pwad',
+		action='store_true',
+		help='Make a PWAD instead of an IWAD.'
+	)
+	args = parser.parse_args()
+
+	entries = dummy(args.path, lumps=args.lumps, textures=args.textures, maps=args.maps, nested=args.nested, seed=args.seed, shared=args.shared, iwad=not args.pwad)
+	print(f'Generated: {args.path} ({len(entries)} entries)')
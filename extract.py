@@ -3,7 +3,7 @@
 if __name__ == '__main__':
 	import argparse
 	from os.path import split, join, isfile
-	from doom.util import chain_args, get_chains, mkzip, extract
+	from doom.util import chain_args, profile_args, start_profile, end_profile, daemon_args, forward_daemon, get_chains, mkzip, extract
 
 	parser = argparse.ArgumentParser(
 		description='Extract a WAD or PK3, extracts all chains in order. '
@@ -27,16 +27,24 @@ if __name__ == '__main__':
 		'-path',
 		help='Directory to extract files to. Also determines name and location of PK3.'
 	)
+	profile_args(parser)
+	daemon_args(parser)
 	args = parser.parse_args()
-	chains = get_chains(args)
+	forward_daemon(args, __file__)
+	start_profile(args)
+	chains = get_chains(args, prefetch=args.modernize)
 
 	for chain in chains:
-		dir_path = extract(chain, path=args.path, with_iwad=args.with_iwad, modernize=args.modernize)
+		# Lumps that come out of a PK3 unchanged get copied into the new one as they are
+		members = {}
+		dir_path = extract(chain, path=args.path, with_iwad=args.with_iwad, modernize=args.modernize, members=members)
 
 		extension = '.pk3'
 		if isfile(join(dir_path, 'iwadinfo.txt')):
 			extension = '.ipk3'
 		pk3_path = join('out', split(dir_path)[-1] + extension)
 		# Don't include composite in pk3, it is only there to demonstrate the rendered textures, not actrually be used in any capacity
-		mkzip(pk3_path, dir_path, exclude=['composite'])
+		mkzip(pk3_path, dir_path, exclude=['composite'], members=members)
 		print('Generated: ' + pk3_path)
+
+	end_profile(args)
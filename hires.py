@@ -5,7 +5,7 @@ if __name__ == '__main__':
 	from math import log
 	from os.path import split, join
 	from os import cpu_count
-	from doom.util import chain_args, get_chains, mkzip, hires
+	from doom.util import chain_args, profile_args, start_profile, end_profile, daemon_args, forward_daemon, get_chains, mkzip, hires
 	from doom.graphic import png_to_waifu2x
 
 	parser = argparse.ArgumentParser(
@@ -33,18 +33,42 @@ if __name__ == '__main__':
 		default=1,
 		type=int
 	)
+	parser.add_argument(
+		'-memory',
+		help='Peak memory in MB to aim for per worker when scaling. Images too big for it are scaled in overlapping tiles.',
+		type=int
+	)
 	parser.add_argument(
 		'-path',
 		help='Directory to extract files to. Also determines name and location of PK3.'
 	)
+	parser.add_argument(
+		'-incremental',
+		action='store_true',
+		help='Update a previous build at the same path instead of starting over. Only textures that changed get scaled again.'
+	)
+	parser.add_argument(
+		'-similar',
+		help='Report graphics of the same name that look nearly the same across IWADs, within this many bits of a 64 bit perceptual hash. 0 only catches identical pixels.',
+		type=int
+	)
+	parser.add_argument(
+		'-mergesimilar',
+		action='store_true',
+		help='Merge the graphics found with -similar so they only get scaled once'
+	)
 	parser.add_argument(
 		'-nopk3',
 		action='store_true',
 		help='Dont create the PK3 normally provided for convenience'
 	)
+	profile_args(parser)
+	daemon_args(parser)
 	
 	args = parser.parse_args()
-	chains = get_chains(args)
+	forward_daemon(args, __file__)
+	start_profile(args)
+	chains = get_chains(args, prefetch=True)
 
 	doubles = log(args.scale, 2)
 	if not doubles.is_integer():
@@ -61,10 +85,13 @@ if __name__ == '__main__':
 			print('WARNING: GPU and Multiprocessing dont get along! Might run out of memory and crash!')
 		# Avoid issues with chainer/cupy when multiprocessing: https://github.com/chainer/chainer/issues/2962
 		import multiprocessing as mp
-		mp.set_start_method('spawn')
+		mp.set_start_method('spawn', force=True)
 
-	dir_path = hires(chains, path=args.path, scale=args.scale, cpu=args.cpu)
+	dir_path = hires(chains, path=args.path, scale=args.scale, cpu=args.cpu, incremental=args.incremental,
+		similarity=args.similar, merge_similar=args.mergesimilar, memory=args.memory)
 	if not args.nopk3:
 		pk3_path = join('out', split(dir_path)[-1] + '.pk3')
 		mkzip(pk3_path, dir_path)
 		print('Generated: ' + pk3_path)
+
+	end_profile(args)
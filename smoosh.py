@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+if __name__ == '__main__':
+	import argparse
+	from os.path import split, join
+	from doom.util import chain_args, profile_args, start_profile, end_profile, daemon_args, forward_daemon, get_chains, mkzip, smoosh
+
+	parser = argparse.ArgumentParser(
+		description='Combine IWADs or map packs into one filtered package, with every lump they have in common stored once. '
+			'Builds appropriate filters for IWAD chains. You may safely use the resulting package with all IWAD/PWAD chains specified.'
+	)
+	chain_args(parser)
+	parser.add_argument(
+		'--with-iwad',
+		action='store_true',
+		help='Include the IWADs of chains that have PWADs, otherwise only the PWADs (map packs) get smooshed.',
+	)
+	parser.add_argument(
+		'-path',
+		help='Directory to extract files to. Also determines name and location of PK3.'
+	)
+	parser.add_argument(
+		'-nopk3',
+		action='store_true',
+		help='Dont create the PK3 normally provided for convenience'
+	)
+	profile_args(parser)
+	daemon_args(parser)
+	
+	args = parser.parse_args()
+	forward_daemon(args, __file__)
+	start_profile(args)
+	chains = get_chains(args, prefetch=True)
+
+	members = {}
+	dir_path = smoosh(chains, path=args.path, with_iwad=args.with_iwad, members=members)
+	if not args.nopk3:
+		pk3_path = join('out', split(dir_path)[-1] + '.pk3')
+		mkzip(pk3_path, dir_path, members=members)
+		print('Generated: ' + pk3_path)
+
+	end_profile(args)